@@ -0,0 +1,137 @@
+from bisect import bisect_right
+from collections import Counter, deque
+from payload import build_payload
+from vehicles import INT, MISSING
+import math
+
+THRESHOLD = 30          # seconds of delay that count as delayed (what the map's ticker always showed)
+WINDOWS = {"15m": 900, "1h": 3600}  # rolling windows kept next to the current snapshot
+BIN = 15                # seconds; window percentiles are read from histograms with this resolution
+SLOT = 60               # seconds; updates inside one slot are merged, bounding a window's memory
+MAX_RANKED = 50         # length of the most-delayed list
+MAX_ROUTES = 10         # length of the worst-routes list
+RANKED_FIELDS = ("route_id", "vehicleNo", "delay", "stop_name", "trip_headsign")
+
+
+# ---------- Per-snapshot aggregates ----------
+def percentile(ordered, p):
+    # nearest rank on a sorted list
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+
+def group_delays(table, field):
+    # one pass over the delay and key columns: key -> [delay]
+    keys = table.texts.get(field)
+    if keys is None: return {}
+    groups = {}
+    for key, delay, kind in zip(keys, table.numbers["delay"], table.kinds["delay"]):
+        if kind >= INT and key is not MISSING and key is not None:
+            groups.setdefault(key, []).append(delay)
+    return groups
+
+
+def summarize(delays, threshold):
+    ordered = sorted(delays)
+    return {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 1), "p50": percentile(ordered, 50),
+            "p90": percentile(ordered, 90), "delayed": len(ordered) - bisect_right(ordered, threshold)}
+
+
+def ranked(table, threshold, limit=MAX_RANKED):
+    rows = sorted(table.where("delay", lambda d: d > threshold), key=lambda i: -table.numbers["delay"][i])[:limit]
+    result = []
+    for i in rows:
+        entry = {"id": table.ids[i]}
+        for f in RANKED_FIELDS:
+            value = table.value(f, i)
+            if value is not MISSING: entry[f] = value
+        result.append(entry)
+    return result
+
+
+# ---------- Rolling windows ----------
+def accumulate(accs, key, count, total, delayed, bins, sign=1):
+    acc = accs.get(key)
+    if acc is None: acc = accs[key] = [0, 0.0, 0, Counter()]
+    acc[0] += sign * count
+    acc[1] += sign * total
+    acc[2] += sign * delayed
+    if sign > 0: acc[3].update(bins)
+    else: acc[3].subtract(bins)
+    return acc
+
+
+class Window:
+    # Running totals over the last span seconds (to within one slot); every vehicle counts once per update.
+    # Adding an update and expiring a slot only touches that data, never the whole window.
+
+    def __init__(self, span):
+        self.span = span
+        self.slots = deque()    # (slot start, {key: [count, total, delayed, Counter of delay bins]})
+        self.totals = {}        # key -> [count, total, delayed, Counter]
+
+    def add(self, t, groups):
+        start = t - t % SLOT
+        if not self.slots or self.slots[-1][0] != start: self.slots.append((start, {}))
+        slot = self.slots[-1][1]
+        for key, values in groups.items():
+            accumulate(slot, key, *values)
+            accumulate(self.totals, key, *values)
+        while self.slots[0][0] + SLOT <= t - self.span:
+            _, old = self.slots.popleft()
+            for key, values in old.items():
+                acc = accumulate(self.totals, key, *values, sign=-1)
+                if acc[0] <= 0: del self.totals[key]
+
+    def stats(self, key):
+        acc = self.totals.get(key)
+        if acc is None: return None
+        count, total, delayed, bins = acc
+        return {"count": count, "mean": round(total / count, 1), "p50": self.percentile(bins, count, 50),
+                "p90": self.percentile(bins, count, 90), "delayed": delayed}
+
+    @staticmethod
+    def percentile(bins, count, p):
+        # middle of the bin holding the nearest rank
+        rank, seen = max(1, math.ceil(count * p / 100)), 0
+        for b in sorted(bins):
+            if bins[b] <= 0: continue
+            seen += bins[b]
+            if seen >= rank: return b * BIN + BIN / 2
+        return None
+
+
+def empty(name):
+    result = {"t": None, "threshold": THRESHOLD, "routes": {}, "stops": {}, "delayed": 0, "worst_routes": [], "most_delayed": []}
+    return payloads(name, result)
+
+
+def payloads(name, result):
+    # (everything, just the ranked vehicles for tickers)
+    ranked_only = {k: result[k] for k in ("t", "threshold", "delayed", "most_delayed")}
+    return build_payload({name: result}), build_payload({name: ranked_only})
+
+
+class DelayStats:
+    # One city's delay analytics, updated once per bus snapshot by the publishing thread.
+    # update() returns the serialized results; readers only ever see finished payloads.
+
+    def __init__(self, name, threshold=THRESHOLD, windows=WINDOWS):
+        self.name = name
+        self.threshold = threshold
+        self.windows = {label: {"routes": Window(span), "stops": Window(span)} for label, span in windows.items()}
+
+    def update(self, table, t):
+        # -> (full analytics payload, most-delayed payload); groups are the routes and stops in this snapshot
+        result = {"t": t, "threshold": self.threshold}
+        for kind, field in (("routes", "route_id"), ("stops", "stop_name")):
+            groups = group_delays(table, field)
+            now = {key: summarize(delays, self.threshold) for key, delays in groups.items()}
+            bins = {key: (s["count"], sum(groups[key]), s["delayed"], Counter(int(d // BIN) for d in groups[key])) for key, s in now.items()}
+            for label, windows in self.windows.items():
+                windows[kind].add(t, bins)
+            result[kind] = {key: {"now": s, **{label: w[kind].stats(key) for label, w in self.windows.items()}} for key, s in now.items()}
+        worst = sorted(result["routes"].items(), key=lambda item: -item[1]["now"]["mean"])[:MAX_ROUTES]
+        result["worst_routes"] = [{"route_id": key, **stats["now"]} for key, stats in worst]
+        result["delayed"] = len(table.where("delay", lambda d: d > self.threshold))
+        result["most_delayed"] = ranked(table, self.threshold)
+        return payloads(self.name, result)
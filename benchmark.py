@@ -0,0 +1,170 @@
+# Ingest and serving benchmark for json_host.py against fake_upstream.py, results as one JSON document:
+#
+#   python benchmark.py --size warsaw=3000 --size gzm=2000 --clients 50 --duration 10 --output bench.json
+from werkzeug.serving import make_server
+import argparse, http.client, json, logging, os, sys, tempfile, threading, time
+import fake_upstream
+
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(values, scale=1000):
+    # milliseconds by default
+    return {"count": len(values), "p50": round(percentile(values, 50) * scale, 3) if values else None,
+            "p99": round(percentile(values, 99) * scale, 3) if values else None,
+            "max": round(max(values) * scale, 3) if values else None}
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat): result = fn()
+    return (time.perf_counter() - started) / repeat, result
+
+
+# ---------- Fetch/parse cost per city ----------
+def bench_parse(host, upstream, cities, repeat):
+    from engineio import EVENT, decode_payload, loads
+    from payload import build_payload
+    from vehicles import VehicleTable
+    results = {}
+    for city in cities:
+        body = b"2\x1e" + upstream.fleet(city["socket_ns"]).frame
+        def parse():
+            frame = [p.data for p in decode_payload(body) if p.sio_type == EVENT][-1]
+            return loads(frame)[1]["data"]
+        parse_s, buses = timed(parse, repeat)
+        table_s, table = timed(lambda: VehicleTable.from_buses(buses), repeat)
+        serialize_s, _ = timed(lambda: build_payload({city["name"]: buses}), repeat)
+        results[city["name"]] = {"vehicles": len(buses), "bytes": len(body), "parse_ms": round(parse_s * 1000, 3),
+                                 "table_ms": round(table_s * 1000, 3), "serialize_ms": round(serialize_s * 1000, 3)}
+    return results
+
+
+# ---------- Updater cycle ----------
+def bench_ingest(host, server, cities, seconds):
+    # latency: upstream fleet update -> published by json_host; cycle: until every city has that update
+    published = {}  # fleet timestamp -> {city: latency}
+    publish = host.publish_buses
+    def recording_publish(city, buses):
+        stamp = max((b.get("timestamp", 0) for b in buses.values()), default=0)
+        published.setdefault(stamp, {})[city["name"]] = time.time() - stamp
+        publish(city, buses)
+    host.publish_buses = recording_publish
+    started = time.time()
+    threading.Thread(target=host.updater, daemon=True).start()
+    while any(not host.bus_snapshots[c["name"]].version for c in cities) and time.time() - started < 120:
+        time.sleep(0.05)
+    cold_start = time.time() - started
+    before = dict(server.upstream.stats)
+    time.sleep(seconds)
+    after = dict(server.upstream.stats)
+    stamps = [s for s, by_city in published.items() if s > started + cold_start and len(by_city) == len(cities)]
+    latencies = [lat for s in stamps for lat in published[s].values()]
+    updates = len(stamps)
+    return {
+        "cold_start_s": round(cold_start, 3),
+        "updates_observed": updates,
+        "update_latency_ms": summary(latencies),
+        "cycle_ms": summary([max(published[s].values()) for s in stamps]),
+        # steady state only, the startup handshakes and stop loads are not counted
+        "upstream_requests": {k: after[k] - before[k] for k in after},
+        "upstream_requests_per_city_update": round(sum(after[k] - before[k] for k in ("handshake", "post", "poll", "stops")) / max(updates * len(cities), 1), 3),
+    }
+
+
+# ---------- Serving ----------
+def load(port, path, headers, clients, seconds, conditional=False):
+    # conditional: every client revalidates with the ETag it got last, like a polling browser
+    latencies, errors, sent = [], [0], [0]
+    deadline = time.time() + seconds
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        mine, etag = [], None
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path, headers={**headers, "If-None-Match": etag} if conditional and etag else headers)
+                r = conn.getresponse()
+                body = r.read()
+                etag = r.getheader("ETag") or etag
+                if r.status not in (200, 304): errors[0] += 1
+                sent[0] += len(body)
+                mine.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.close()
+        latencies.extend(mine)
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return {"requests_per_s": round(len(latencies) / seconds, 1), "errors": errors[0],
+            "bytes_per_request": round(sent[0] / max(len(latencies), 1)), "latency_ms": summary(latencies)}
+
+
+def bench_serving(host, city, center, clients, seconds):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, host.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port, gzip = server.server_port, {"Accept-Encoding": "gzip"}
+    seq = host.bus_feeds[city].seq
+    scenarios = {
+        "bus_data": (f"/busproject/{city}_bus_data.json", False),
+        "bus_data_conditional": (f"/busproject/{city}_bus_data.json", True),
+        "bus_delta": (f"/busproject/{city}_bus_delta.json?since={seq - 1}", False),
+        "stops": (f"/busproject/{city}_stop.json", False),
+        "near": (f"/busproject/{city}_near.json?lat={center[0]}&lon={center[1]}&n=10", False),
+        "status": ("/busproject/status.json", False),
+    }
+    results = {name: load(port, path, gzip, clients, seconds, conditional) for name, (path, conditional) in scenarios.items()}
+    server.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="json_host ingest and serving benchmark")
+    parser.add_argument("--cities", type=int, default=14, help="how many of the configured cities to ingest")
+    parser.add_argument("--vehicles", type=int, default=200, help="vehicles per city")
+    parser.add_argument("--size", action="append", default=[], metavar="CITY=N", help="vehicles for one city")
+    parser.add_argument("--stops", type=int, default=1000)
+    parser.add_argument("--period", type=float, default=3, help="seconds between fake fleet updates")
+    parser.add_argument("--latency", type=float, default=0, help="ms of fake upstream latency")
+    parser.add_argument("--fail-rate", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0)
+    parser.add_argument("--ingest-time", type=float, default=15, help="seconds to observe the updater")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent HTTP clients")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per serving scenario")
+    parser.add_argument("--repeat", type=int, default=20, help="iterations per parse measurement")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    upstream = fake_upstream.make_server(0, sizes=fake_upstream.parse_sizes(args.size), default_size=args.vehicles, stops=args.stops,
+                                         period=args.period, latency=args.latency, fail_rate=args.fail_rate, drop_rate=args.drop_rate)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    # must be set before json_host/upstream are imported
+    os.environ["CZYNACZAS_BASE"] = f"http://127.0.0.1:{upstream.server_port}"
+    os.environ["STOP_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench_stops_")
+    os.environ.pop("BUS_RECORD_DIR", None)
+    import json_host as host
+    del host.cities[args.cities:]
+    biggest = max(host.cities, key=lambda c: upstream.upstream.sizes.get(c["socket_ns"], args.vehicles))["name"]
+
+    results = {"config": vars(args), "python": sys.version.split()[0]}
+    results["parse"] = bench_parse(host, upstream.upstream, host.cities, args.repeat)
+    results["ingest"] = bench_ingest(host, upstream, host.cities, args.ingest_time)
+    center = upstream.upstream.fleet(biggest).center
+    results["serving"] = {"city": biggest, **bench_serving(host, biggest, center, args.clients, args.duration)}
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
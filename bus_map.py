@@ -1,10 +1,17 @@
+from analytics import DelayStats
 from flask import Flask, render_template_string, jsonify, request
-import requests, re, json, time, threading
+from feed import DeltaFeed
+from metrics import Gauge, instrument
+from payload import build_payload, serve_payload
+from snapshot import BusSnapshot, bus_clusters, empty_buses, empty_stops, stop_clusters, stops_snapshot
+from spatial import GridIndex, parse_bbox
+from stream import Broadcaster, format_event
+from upstream import BASE, SocketSession, fetch_stops, load_cached_stops, make_headers, stage_seconds
+from vehicles import VehicleTable
+import math, time, threading
 
 app = Flask(__name__)
-
-BASE = "https://czynaczas.pl"
-SOCKET = f"{BASE}/socket.io/?EIO=4&transport=polling"
+instrument(app)
 
 cities = [
     {"name": "zielonagora", "stops_url": f"{BASE}/api/zielonagora/transport", "socket_ns": "zielonagora", "referer": f"{BASE}/zielonagora", "center": [51.94,15.50], "zoom": 13},
@@ -23,69 +30,107 @@ cities = [
     {"name": "trojmiasto", "stops_url": f"{BASE}/api/trojmiasto/transport", "socket_ns": "trojmiasto", "referer": f"{BASE}/trojmiasto", "center": [54.35,18.65], "zoom": 12},
 ]
 
-COOKIE = ""
-active_city_name = "zielonagora"
-latest_buses = {}
-latest_stops = {}
-lock = threading.Lock()
-
-# --- Fetch buses/stops functions ---
-def fetch_buses_once(city):
-    headers = {"User-Agent": "Mozilla/5.0", "Origin": BASE, "Referer": city["referer"], "Accept": "*/*"}
-    if COOKIE: headers["Cookie"] = COOKIE
-    try:
-        r = requests.get(SOCKET, headers=headers, timeout=6)
-        sid_match = re.search(r'"sid":"([^"]+)"', r.text)
-        if not sid_match: return {}
-        sid = sid_match.group(1)
-        url = f"{SOCKET}&sid={sid}"
-        requests.post(url, headers=headers, data=f'40/{city["socket_ns"]},{{}}', timeout=6)
-        time.sleep(1)
-        r = requests.get(url, headers=headers, timeout=6)
-        if f"42/{city['socket_ns']}" not in r.text: return {}
-        payload = r.text.split(f"42/{city['socket_ns']},")[1]
-        data = json.loads(payload)
-        return data[1].get("data", {})
-    except Exception as e:
-        print(f"[{city['name']}] bus fetch error:", e)
-        return {}
-
-def fetch_stops(city):
-    headers = {"User-Agent": "Mozilla/5.0", "Origin": BASE, "Referer": city["referer"], "Accept": "*/*"}
-    if COOKIE: headers["Cookie"] = COOKIE
-    try:
-        r = requests.get(city["stops_url"], headers=headers, timeout=6)
-        r.raise_for_status()
-        data = r.json()
-        stops = data.get("stops", [])
-        result = []
-        for s in stops:
-            if len(s) >= 4:
-                result.append({
-                    "id": s[0],
-                    "name": s[1],
-                    "lat": s[2],
-                    "lon": s[3],
-                    "stop_name": f"{s[1]} - {s[0]}",
-                    "trip_headsign": s[4] if len(s) > 4 else ""
-                })
-        return result
-    except Exception as e:
-        print(f"[{city['name']}] stop fetch error:", e)
-        return []
+STOPS_INTERVAL = 3600   # seconds between stop refreshes of one city
+STOPS_RETRY = 60        # seconds before retrying a failed stop refresh
+BUS_MAX_AGE = 2         # Cache-Control max-age for bus data
+IDLE_TTL = 60           # seconds a city stays warm after its last request or stream subscriber
+FIRST_DATA_TIMEOUT = 8  # seconds a request for a cold city waits for its first data
+active_city_name = "zielonagora"    # default for requests without ?city=
+cities_by_name = {c["name"]: c for c in cities}
+# city -> immutable snapshot, replaced as a whole on every update; requests read them without locking
+bus_snapshots = {c["name"]: empty_buses(c["name"]) for c in cities}
+stop_snapshots = {c["name"]: empty_stops(c["name"]) for c in cities}
+sessions = {}           # city -> SocketSession, one per warm city
+last_demand = {}        # city -> unix time of the last request for it
+stops_due = {}          # city -> unix time of the next stop refresh
+first_buses = {c["name"]: threading.Event() for c in cities}
+first_stops = {c["name"]: threading.Event() for c in cities}
+bus_feeds = {c["name"]: DeltaFeed() for c in cities}
+streams = {c["name"]: Broadcaster() for c in cities}
+delay_stats = {c["name"]: DelayStats(c["name"]) for c in cities}
+sessions_lock = threading.Lock()    # demand bookkeeping, starting and closing sessions; never held while serving data
+stops_lock = threading.Lock()       # claiming a city's stop refresh, so only one thread fetches it
+publish_locks = {c["name"]: threading.Lock() for c in cities}   # a closed session may still be finishing a frame
+
+Gauge("city_data_age_seconds", "Seconds since upstream last sent bus data, warm cities only", ("city",),
+      lambda: {(name,): round(time.time() - s.last_frame, 1) if s.last_frame else None for name, s in list(sessions.items())})
+Gauge("city_vehicles", "Vehicles in the latest snapshot", ("city",), lambda: {(name,): len(s.table) for name, s in bus_snapshots.items() if s.version})
+Gauge("city_stops", "Stops currently served", ("city",), lambda: {(name,): len(s.stops) for name, s in stop_snapshots.items() if s.version})
 
 # --- Background updater ---
+def publish_buses(city, buses, session):
+    name = city["name"]
+    # one publisher per city at a time, and only the city's current session
+    with publish_locks[name]:
+        if sessions.get(name) is not session: return
+        with stage_seconds.time(name, "normalize"):
+            table = VehicleTable.from_buses(buses)
+            if table == bus_snapshots[name].table: return
+            payload = build_payload({name: buses})
+            index = GridIndex(table.positions())
+            feed = bus_feeds[name]
+            seq = feed.push(table)
+        now = time.time()
+        with stage_seconds.time(name, "analytics"):
+            delays, ranked = delay_stats[name].update(table, now)
+        bus_snapshots[name] = BusSnapshot(seq, table, payload, now, index, delays, ranked)
+        seq, delta = feed.versioned_payload(seq - 1)
+        streams[name].publish(format_event("buses", delta.raw, seq))
+        # the ticker's list is ranked once here, not by every open page
+        streams[name].publish(format_event("delays", ranked.raw))
+
+def frame_arrived(name, session):
+    # upstream answered, also with no vehicles or unchanged ones: what is served is current
+    if sessions.get(name) is session: first_buses[name].set()
+
+def publish_stops(city, stops):
+    stop_snapshots[city["name"]] = stops_snapshot(city["name"], stops)
+    first_stops[city["name"]].set()
+    # the page loads stops for its viewport, so only announce that they changed
+    streams[city["name"]].publish(format_event("stops", build_payload({city["name"]: len(stops)}).raw))
+
+def refresh_stops(city):
+    # stops come from the disk cache first and are refreshed only when stale
+    with stops_lock:
+        if city["name"] not in stops_due:
+            stops, fetched_at = load_cached_stops(city)
+            if stops: publish_stops(city, stops)
+            stops_due[city["name"]] = fetched_at + STOPS_INTERVAL
+        if stops_due[city["name"]] > time.time(): return
+        stops_due[city["name"]] = math.inf    # in flight: warm_up and the updater never both fetch
+    stops = fetch_stops(city)
+    if stops and stops is not stop_snapshots[city["name"]].stops: publish_stops(city, stops)
+    stops_due[city["name"]] = time.time() + (STOPS_INTERVAL if stops else STOPS_RETRY)
+    # a failed or empty first load is an answer too; requests stop waiting for it
+    first_stops[city["name"]].set()
+
+def warm_up(city):
+    # concurrent requests for a cold city share one session and one stop load; the demand is recorded
+    # under the lock the updater closes idle sessions with, so a city seen warm here is not closed under it
+    with sessions_lock:
+        last_demand[city["name"]] = time.time()
+        if city["name"] in sessions: return
+        session = sessions[city["name"]] = SocketSession(city["socket_ns"], make_headers(city), lambda buses: publish_buses(city, buses, session),
+                                                           lambda: frame_arrived(city["name"], session))
+    session.start()
+    threading.Thread(target=refresh_stops, args=(city,), daemon=True).start()
+
 def updater():
-    global latest_buses, latest_stops, active_city_name
+    # every city with recent demand keeps its own session; idle ones are closed after IDLE_TTL
     while True:
-        with lock:
-            city = next((c for c in cities if c["name"] == active_city_name), None)
-        if city:
-            buses = fetch_buses_once(city)
-            stops = fetch_stops(city)
-            if buses: latest_buses[city["name"]] = buses
-            if stops: latest_stops[city["name"]] = stops
-        time.sleep(4)
+        for name, session in list(sessions.items()):
+            with sessions_lock:
+                now = time.time()
+                idle = not streams[name].subscribers and now - last_demand.get(name, 0) > IDLE_TTL
+                if idle:
+                    del sessions[name]
+                    first_buses[name].clear()
+            if idle:
+                session.stop()
+                print(f"💤 {name} idle, session closed")
+            elif stops_due.get(name, now) < now:
+                refresh_stops(cities_by_name[name])
+        time.sleep(1)
 
 # --- Flask routes ---
 @app.route("/")
@@ -102,8 +147,6 @@ def index():
 <style>
 html,body,#map{height:100%;margin:0;background:#101010;color:#0f0;font-family:'Courier New',monospace;}
 .leaflet-container { background:#101010; }
-.bus-label { font-size:12px; text-align:center; margin-top:5px; font-weight:bold; }
-.stop-label { font-size:12px;color:#00ffff;text-align:center;font-weight:bold;text-shadow:0 0 2px black; }
 #bus-info { position: fixed; bottom:0; left:0; width:100%; background: rgba(0,0,0,0.85); color:#0f0; font-size:14px; padding:6px 10px; z-index:9999; border-top:1px solid #0f0; }
 #toggle-map-mode {
     position: fixed;
@@ -142,7 +185,6 @@ html,body,#map{height:100%;margin:0;background:#101010;color:#0f0;font-family:'C
 }
 
 @keyframes scroll-left { 0% { transform: translateX(100%); } 100% { transform: translateX(-100%); } }
-@keyframes rgbGlow { 0% { filter: drop-shadow(0 0 3px red); } 25% { filter: drop-shadow(0 0 3px lime); } 50% { filter: drop-shadow(0 0 3px cyan); } 75% { filter: drop-shadow(0 0 3px magenta); } 100% { filter: drop-shadow(0 0 3px red); } }
 </style>
 </head>
 <body>
@@ -157,6 +199,7 @@ html,body,#map{height:100%;margin:0;background:#101010;color:#0f0;font-family:'C
   <div class="city-btn" onclick="switchCity('warsaw')">Warszawa</div>
   <div class="city-btn" onclick="switchCity('poznan')">Poznań</div>
   <div class="city-btn" onclick="switchCity('kielce')">Kielce</div>
+  <div class="city-btn" onclick="switchCity('krakow')">Kraków</div>
   <div class="city-btn" onclick="switchCity('leszno')">Leszno</div>
   <div class="city-btn" onclick="switchCity('lodz')">Lodz</div>
   <div class="city-btn" onclick="switchCity('gzm')">Katowice GZM</div>
@@ -164,14 +207,54 @@ html,body,#map{height:100%;margin:0;background:#101010;color:#0f0;font-family:'C
   <div class="city-btn" onclick="switchCity('slupsk')">Slupsk</div>
   <div class="city-btn" onclick="switchCity('swinoujscie')">Swinoujscie</div>
   <div class="city-btn" onclick="switchCity('szczecin')">szczecin</div>
-  <div class="city-btn" onclick="switchCity('trojmoasto')">Trojmiasto</div>
+  <div class="city-btn" onclick="switchCity('trojmiasto')">Trojmiasto</div>
 </div>
 
 <script>
-const map=L.map('map').setView([51.94,15.50],13);
+// Every vehicle, stop and cluster is drawn on one canvas instead of being its own DOM element
+const map=L.map('map',{preferCanvas:true}).setView([51.94,15.50],13);
 L.tileLayer('https://{s}.basemaps.cartocdn.com/dark_nolabels/{z}/{x}/{y}{r}.png',{maxZoom:19}).addTo(map);
+const canvas=L.canvas({padding:0.5});
+const BUS_DETAIL_ZOOM=13;   // further out buses come as server-side clusters
+const LABEL_ZOOM=15;        // closer in buses and stops get their text
+
+let busMarkers={},busDrawn={},stopMarkers={},trackedBusId=null,stopsVisible=true,currentCity='zielonagora',userMarker=null;
+let busState={},busSeq=null,source=null,busClustersDue=null;
+const stopLayer=L.layerGroup().addTo(map), busClusterLayer=L.layerGroup().addTo(map);
+const cityData={{ cities|tojson }};
+
+function drawText(ctx,p,text,dy,color){
+  if(!text)return;
+  ctx.font='bold 12px Courier New';
+  ctx.textAlign='center';
+  ctx.fillStyle=color;
+  ctx.fillText(text,p.x,p.y+dy);
+}
 
-let busMarkers={},stopMarkers=[],trackedBusId=null,stopsVisible=true,currentCity='zielonagora',userMarker=null;
+// A circle with optional text (stops and clusters)
+const Dot=L.CircleMarker.extend({
+  _updatePath(){
+    L.CircleMarker.prototype._updatePath.call(this);
+    if(this._renderer._drawing&&!this._empty()) drawText(this._renderer._ctx,this._point,this.options.text,this.options.textOffset||4,this.options.textColor||'#fff');
+  }
+});
+
+// A bus: an arrow pointing along its heading, in its delay colour, with route / vehicle number under it
+const BusArrow=L.CircleMarker.extend({
+  _updatePath(){
+    const r=this._renderer;
+    if(!r._drawing||this._empty())return;
+    const ctx=r._ctx,p=this._point,s=this._radius,a=(this.options.angle||0)*Math.PI/180,sin=Math.sin(a),cos=Math.cos(a);
+    ctx.beginPath();
+    ctx.moveTo(p.x+sin*s*1.5,p.y-cos*s*1.5);
+    ctx.lineTo(p.x-sin*s*0.8+cos*s,p.y+cos*s*0.8+sin*s);
+    ctx.lineTo(p.x-sin*s*0.3,p.y+cos*s*0.3);
+    ctx.lineTo(p.x-sin*s*0.8-cos*s,p.y+cos*s*0.8-sin*s);
+    ctx.closePath();
+    r._fillStroke(ctx,this);
+    drawText(ctx,p,this.options.text,s+14,this.options.fillColor);
+  }
+});
 
 let marqueeSpan = document.querySelector("#marquee span");
 
@@ -239,26 +322,25 @@ function delayColor(delay){
 
 document.getElementById('toggle-stops').addEventListener('click',()=>{
   stopsVisible=!stopsVisible;
-  stopMarkers.forEach(m=>stopsVisible?map.addLayer(m):map.removeLayer(m));
+  stopsVisible?map.addLayer(stopLayer):map.removeLayer(stopLayer);
   document.getElementById('toggle-stops').innerText=stopsVisible?'Hide Stops':'Show Stops';
 });
 
 function clearMap(){
   Object.values(busMarkers).forEach(m=>map.removeLayer(m));
-  stopMarkers.forEach(m=>map.removeLayer(m));
-  busMarkers={}; stopMarkers=[]; trackedBusId=null;
+  stopLayer.clearLayers(); busClusterLayer.clearLayers();
+  busMarkers={}; busDrawn={}; stopMarkers={}; trackedBusId=null;
+  busState={}; busSeq=null;
 }
 
-async function switchCity(name){
+function switchCity(name){
   if(name===currentCity)return;
   clearMap();
   currentCity=name;
   document.getElementById('bus-info').innerText='Loading '+name+'...';
-  await fetch('/set_city',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({name})});
-  const cityData={'zielonagora':[51.94,15.50,13],'wroclaw':[51.11,17.03,13],'warsaw':[52.23,21.01,12],'poznan':[52.41,16.93,13],'krakow':[50.06,19.94,13]};
   const c=cityData[name];
   map.setView([c[0],c[1]],c[2]);
-  setTimeout(update,1000);
+  subscribe();
 }
 
 // User GPS
@@ -273,91 +355,223 @@ if (navigator.geolocation){
     }, err=>console.warn(err));
 }
 
-async function update(){
-  const [busRes,stopRes]=await Promise.all([
-    fetch('/api/buses?city='+currentCity),
-    fetch('/api/stops?city='+currentCity)
-  ]);
-  const buses=(await busRes.json())[currentCity]||{};
-  const stops=(await stopRes.json())[currentCity]||[];
-
-  if(stopMarkers.length===0){
-    stops.forEach(s=>{
-      const m=L.marker([s.lat,s.lon],{icon:L.divIcon({className:'stop-label',html:`🚩<br>${s.stop_name}`,iconSize:[60,25],iconAnchor:[30,0]})});
-      m.addTo(map);
-      m.on('click',()=>{trackedBusId=null;document.getElementById('bus-info').innerHTML=`Stop: ${s.stop_name}`;});
-      stopMarkers.push(m);
-    });
-  }
+// The server pushes stops once per connection and a bus delta per upstream update
+function subscribe(){
+  if(source) source.close();
+  source=new EventSource('/api/stream?city='+currentCity);
+  source.addEventListener('stops',()=>loadStops());
+  source.addEventListener('buses',e=>applyDelta(JSON.parse(e.data)));
+  source.addEventListener('delays',e=>showDelays((JSON.parse(e.data)[currentCity]||{}).most_delayed||[]));
+}
 
-  let delayedBuses=[];
-  Object.entries(buses).forEach(([id,b])=>{
-    if(!b.lat||!b.lon)return;
-    const route=b.route_id||'?', busNo=b.vehicleNo||'?', angle=(b.angle||0)-90;
-    const color=delayColor(b.delay||0);
-    if(b.delay>30) delayedBuses.push(`${route}/${busNo} | Delay: ${b.delay}s | Stop: ${b.stop_name||'n/a'} | Driving to: ${b.trip_headsign||'n/a'}`);
-
-    const iconHtml=`<div style="text-align:center;">
-      <div style="font-size:30px; transform: rotate(${angle}deg); color:${color}; animation: rgbGlow 2s infinite linear;">➤</div>
-      <div class="bus-label" style="color:${color};">${route} / ${busNo}</div>
-    </div>`;
-    const icon=L.divIcon({className:'',html:iconHtml,iconSize:[60,60],iconAnchor:[30,20]});
-
-    if(!busMarkers[id]){
-      busMarkers[id]=L.marker([b.lat,b.lon],{icon}).addTo(map);
-      busMarkers[id].on('click',()=>{
-        trackedBusId=id;
-        document.getElementById('bus-info').innerHTML=`Bus: ${route} / ${busNo} | Status: ${b.current_status||'n/a'} | Driving to: ${b.trip_headsign||'n/a'} | Stop: ${b.stop_name||'n/a'} | Delay: ${b.delay}s | Speed: ${b.speed||'n/a'}km/h`;
-      });
-    } else {
-      busMarkers[id].setLatLng([b.lat,b.lon]);
-      busMarkers[id].setIcon(icon);
-    }
+// The server ranks delayed vehicles once per update; the page only formats its list
+function showDelays(delayed){
+  updateMarquee(delayed.map(b=>`${b.route_id||'?'}/${b.vehicleNo||'?'} | Delay: ${b.delay}s | Stop: ${b.stop_name||'n/a'} | Driving to: ${b.trip_headsign||'n/a'}`).join("   •   "));
+}
 
-    if(trackedBusId===id){
-      document.getElementById('bus-info').innerHTML=`Bus: ${route} / ${busNo} | Status: ${b.current_status||'n/a'} | Driving to: ${b.trip_headsign||'n/a'} | Stop: ${b.stop_name||'n/a'} | Delay: ${b.delay}s | Speed: ${b.speed||'n/a'}km/h`;
-    }
+// The server returns only what is inside the visible area, merged into clusters when zoomed out
+async function loadClusters(type){
+  const b=map.getBounds(), city=currentCity, zoom=map.getZoom();
+  const bbox=[b.getSouth(),b.getWest(),b.getNorth(),b.getEast()].join(',');
+  const res=await fetch(`/api/clusters?city=${city}&type=${type}&zoom=${zoom}&bbox=${bbox}`);
+  if(city!==currentCity||zoom!==map.getZoom())return null;
+  return (await res.json())[city]||[];
+}
+
+function clusterDot(c,color){
+  const radius=Math.min(8+Math.log2(c.count)*3,30);
+  return new Dot([c.lat,c.lon],{renderer:canvas,radius,color,fillColor:color,fillOpacity:0.35,weight:2,text:String(c.count),textColor:'#fff'})
+    .on('click',()=>map.setView([c.lat,c.lon],Math.min(map.getZoom()+2,18)));
+}
+
+async function loadStops(){
+  const items=await loadClusters('stops');
+  if(items) drawStops(items);
+}
+
+function drawStops(items){
+  // markers are kept between calls, so panning only adds and removes the difference
+  const visible={}, labels=map.getZoom()>=LABEL_ZOOM;
+  items.forEach(s=>{
+    const key=s.count?`c${s.lat},${s.lon},${s.count}`:`s${s.id}${labels}`;
+    visible[key]=true;
+    if(stopMarkers[key])return;
+    const m=s.count?clusterDot(s,'#00ffff'):new Dot([s.lat,s.lon],{renderer:canvas,radius:4,color:'#00ffff',fillColor:'#00ffff',fillOpacity:0.9,weight:1,text:labels?s.stop_name:null,textOffset:16,textColor:'#00ffff'})
+      .on('click',()=>{trackedBusId=null;document.getElementById('bus-info').innerHTML=`Stop: ${s.stop_name}`;});
+    stopLayer.addLayer(m);
+    stopMarkers[key]=m;
   });
+  Object.keys(stopMarkers).forEach(key=>{if(!visible[key]){stopLayer.removeLayer(stopMarkers[key]);delete stopMarkers[key];}});
+}
 
-  if(trackedBusId && buses[trackedBusId]){
-    const b=buses[trackedBusId];
-    map.setView([b.lat,b.lon],map.getZoom(),{animate:true});
+function loadBusClusters(){
+  // at most one request per second, however many updates arrive
+  if(busClustersDue)return;
+  busClustersDue=setTimeout(async()=>{
+    const items=await loadClusters('buses');
+    busClustersDue=null;
+    if(!items||map.getZoom()>=BUS_DETAIL_ZOOM)return;
+    busClusterLayer.clearLayers();
+    items.forEach(b=>busClusterLayer.addLayer(b.count?clusterDot(b,delayColor(b.delay||0)):busArrow(b.id,b)));
+  },1000);
+}
+
+function applyDelta(delta){
+  // events queued before the initial snapshot are already included in it
+  if(!delta.full && busSeq!==null && delta.seq<=busSeq)return;
+  // only vehicles that were added, removed or changed since busSeq are sent
+  if(delta.full){
+    Object.keys(busMarkers).forEach(id=>{if(!(id in delta.added))removeBus(id);});
+    busState={};
   }
+  Object.assign(busState,delta.added);
+  Object.entries(delta.changed).forEach(([id,fields])=>Object.assign(busState[id],fields));
+  delta.removed.forEach(id=>{delete busState[id];removeBus(id);});
+  busSeq=delta.seq;
+  // ...and only those are redrawn
+  if(map.getZoom()>=BUS_DETAIL_ZOOM) [...Object.keys(delta.added),...Object.keys(delta.changed)].forEach(drawBus);
+  else loadBusClusters();
+  showTracked();
+}
 
-  updateMarquee(delayedBuses.length>0 ? delayedBuses.join("   •   ") : "No buses delayed over 30s.");
+function busInfo(b){
+  return `Bus: ${b.route_id||'?'} / ${b.vehicleNo||'?'} | Status: ${b.current_status||'n/a'} | Driving to: ${b.trip_headsign||'n/a'} | Stop: ${b.stop_name||'n/a'} | Delay: ${b.delay}s | Speed: ${b.speed||'n/a'}km/h`;
 }
 
-update();
-setInterval(update,4000);
+function busArrow(id,b){
+  return new BusArrow([b.lat,b.lon],{renderer:canvas,radius:8,color:'#000',weight:1,fillColor:delayColor(b.delay||0),fillOpacity:1,angle:b.angle||0,
+    text:map.getZoom()>=LABEL_ZOOM?`${b.route_id||'?'} / ${b.vehicleNo||'?'}`:null})
+    .on('click',()=>{trackedBusId=id;document.getElementById('bus-info').innerHTML=busInfo(busState[id]||b);});
+}
+
+function drawBus(id){
+  const b=busState[id];
+  if(!b||!b.lat||!b.lon||!map.getBounds().pad(0.2).contains([b.lat,b.lon])){removeBus(id);return;}
+  // nothing that is drawn changed: leave the canvas alone
+  const look=[b.lat,b.lon,b.angle,b.delay,b.route_id,b.vehicleNo,map.getZoom()>=LABEL_ZOOM].join('|');
+  if(busDrawn[id]===look)return;
+  removeBus(id);
+  busMarkers[id]=busArrow(id,b).addTo(map);
+  busDrawn[id]=look;
+}
+
+function removeBus(id){
+  if(busMarkers[id]){map.removeLayer(busMarkers[id]);delete busMarkers[id];delete busDrawn[id];}
+}
+
+function showTracked(){
+  const b=trackedBusId&&busState[trackedBusId];
+  if(!b)return;
+  document.getElementById('bus-info').innerHTML=busInfo(b);
+  map.setView([b.lat,b.lon],map.getZoom(),{animate:true});
+}
+
+function onMove(){
+  loadStops();
+  if(map.getZoom()>=BUS_DETAIL_ZOOM){
+    busClusterLayer.clearLayers();
+    Object.keys(busMarkers).forEach(id=>{if(!(id in busState))removeBus(id);});
+    Object.keys(busState).forEach(drawBus);
+  } else {
+    Object.keys(busMarkers).forEach(removeBus);
+    loadBusClusters();
+  }
+}
+
+subscribe();
+map.on('moveend',onMove);
 map.on('click',()=>{trackedBusId=null;document.getElementById('bus-info').innerHTML="Click a bus or stop to see info...";});
 </script>
 </body>
 </html>
     """
-    return render_template_string(html)
+    return render_template_string(html, cities={c["name"]: c["center"] + [c["zoom"]] for c in cities})
+
+def requested_city(wait=None):
+    # marks demand for the requested city; wait: Event dict to block on while the city is cold
+    city = cities_by_name.get(request.args.get("city", active_city_name))
+    if city:
+        warm_up(city)
+        if wait: wait[city["name"]].wait(FIRST_DATA_TIMEOUT)
+    return city
 
 @app.route("/api/buses")
 def api_buses():
-    city = request.args.get("city", active_city_name)
-    with lock:
-        return jsonify({city: latest_buses.get(city, {})})
+    city = requested_city(first_buses)
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    return serve_payload(bus_snapshots[city["name"]].payload, BUS_MAX_AGE)
+
+@app.route("/api/buses/delta")
+def api_buses_delta():
+    city = requested_city(first_buses)
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    return serve_payload(bus_feeds[city["name"]].payload(request.args.get("since", type=int)), BUS_MAX_AGE)
+
+@app.route("/api/stream")
+def api_stream():
+    # no waiting here: the first data is pushed to the stream as soon as it arrives
+    city = requested_city()
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    name = city["name"]
+    feed = bus_feeds[name]
+    # a reconnecting EventSource sends Last-Event-ID; the first connection may pass ?since=
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None: since = request.args.get("since", type=int)
+    def snapshot():
+        seq, payload = feed.versioned_payload(since)
+        return [format_event("stops", build_payload({name: len(stop_snapshots[name].stops)}).raw), format_event("buses", payload.raw, seq),
+                format_event("delays", bus_snapshots[name].ranked.raw)]
+    return streams[name].response(snapshot)
+
+@app.route("/api/delays")
+def api_delays():
+    city = requested_city(first_buses)
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    snapshot = bus_snapshots[city["name"]]
+    return serve_payload(snapshot.ranked if "ranked" in request.args else snapshot.delays, BUS_MAX_AGE)
+
+@app.route("/api/clusters")
+def api_clusters():
+    # what the page draws: single stops/buses up close, merged per screen cell further out
+    city = requested_city(first_stops if request.args.get("type", "stops") == "stops" else first_buses)
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    try:
+        zoom, bbox = int(request.args["zoom"]), parse_bbox(request.args["bbox"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "zoom and bbox=south,west,north,east are required"}), 400
+    name = city["name"]
+    if request.args.get("type", "stops") == "buses":
+        return jsonify({name: bus_clusters(bus_snapshots[name], zoom, bbox)})
+    return jsonify({name: stop_clusters(stop_snapshots[name], zoom, bbox)})
 
 @app.route("/api/stops")
 def api_stops():
-    city = request.args.get("city", active_city_name)
-    with lock:
-        return jsonify({city: latest_stops.get(city, [])})
+    city = requested_city(first_stops)
+    if city is None:
+        return jsonify({"error": "unknown city"}), 404
+    snapshot = stop_snapshots[city["name"]]
+    if "bbox" in request.args:
+        try:
+            bbox = parse_bbox(request.args["bbox"])
+        except ValueError:
+            return jsonify({"error": "bbox must be south,west,north,east"}), 400
+        return jsonify({city["name"]: snapshot.index.bbox(*bbox)})
+    # revalidated every time: a cold city may still answer with an empty list
+    return serve_payload(snapshot.payload, 0)
 
 @app.route("/set_city", methods=["POST"])
 def set_city():
-    global active_city_name
+    # kept for old pages: it only warms the city up, every client picks its own city with ?city=
     data = request.get_json()
-    name = data.get("name")
-    if name not in [c["name"] for c in cities]:
+    city = cities_by_name.get(data.get("name"))
+    if city is None:
         return jsonify({"error": "unknown city"}), 400
-    with lock:
-        active_city_name = name
-    print(f"🟢 City changed to: {active_city_name}")
+    warm_up(city)
     return jsonify({"ok": True})
 
 if __name__ == "__main__":
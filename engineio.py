@@ -0,0 +1,56 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Engine.IO v4 packet types, as the byte values they are sent as
+OPEN, CLOSE, PING, PONG, MESSAGE, UPGRADE, NOOP = b"0123456"
+# Socket.IO packet types carried inside an Engine.IO MESSAGE
+CONNECT, DISCONNECT, EVENT, ACK, CONNECT_ERROR = b"01234"
+SEPARATOR = b"\x1e"
+
+
+def loads(data):
+    # orjson parses bytes/memoryview directly; the stdlib needs a bytes copy
+    if orjson: return orjson.loads(data)
+    return json.loads(bytes(data))
+
+
+# ---------- Decoding ----------
+class Packet:
+    __slots__ = ("type", "sio_type", "namespace", "data")
+
+    def __init__(self, type, sio_type=None, namespace=None, data=b""):
+        self.type = type
+        self.sio_type = sio_type
+        self.namespace = namespace
+        self.data = data    # memoryview into the response body, never copied
+
+
+def decode_payload(body):
+    # one polling response -> Packet per \x1e-separated packet
+    view = memoryview(body)
+    start, size = 0, len(body)
+    while start < size:
+        end = body.find(SEPARATOR, start)
+        if end == -1: end = size
+        if end > start: yield decode_packet(body, view, start, end)
+        start = end + 1
+
+
+def decode_packet(body, view, start, end):
+    kind = body[start]
+    if kind != MESSAGE or end - start < 2:
+        return Packet(kind, data=view[start + 1:end])
+    sio_type, i = body[start + 1], start + 2
+    namespace = "/"
+    if i < end and body[i] == ord("/"):
+        comma = body.find(b",", i, end)
+        ns_end = end if comma == -1 else comma
+        namespace = body[i:ns_end].decode()
+        i = ns_end + 1
+    # optional ack id between namespace and data
+    while i < end and 48 <= body[i] <= 57: i += 1
+    return Packet(kind, sio_type, namespace, view[i:end])
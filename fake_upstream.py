@@ -0,0 +1,210 @@
+# Local stand-in for czynaczas.pl, so the hosts can be run and benchmarked without touching
+# (or getting banned by) the real site:
+#
+#   python fake_upstream.py --port 8765 --size warsaw=3000 --latency 20 --fail-rate 0.01
+#   CZYNACZAS_BASE=http://127.0.0.1:8765 python json_host.py
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse, hashlib, json, math, random, threading, time, uuid
+
+PING_INTERVAL = 25000   # ms, announced in the handshake like the real server
+PING_TIMEOUT = 20000
+
+
+# ---------- Simulated fleets ----------
+class Fleet:
+    # One city's vehicles and stops; step() moves every vehicle and builds the next 42/<ns> frame.
+
+    def __init__(self, name, size, stops):
+        rnd = self.random = random.Random(name)
+        self.name = name
+        self.center = (50 + rnd.uniform(0, 4), 15 + rnd.uniform(0, 7))
+        self.stops = [[f"{i}", f"Stop {i}", *self.around(0.1), f"Direction {i % 20}"] for i in range(stops)]
+        self.vehicles = {}
+        for i in range(size):
+            lat, lon = self.around(0.1)
+            self.vehicles[str(1000 + i)] = {
+                "lat": lat, "lon": lon, "angle": rnd.randrange(360), "speed": 0, "delay": 0,
+                "route_id": str(rnd.randrange(1, 80)), "vehicleNo": str(1000 + i),
+                "trip_headsign": f"Direction {rnd.randrange(20)}", "stop_name": f"Stop {rnd.randrange(max(stops, 1))}",
+                "current_status": "IN_TRANSIT_TO", "timestamp": 0,
+            }
+        body = json.dumps({"stops": self.stops}).encode()
+        self.stops_body, self.stops_etag = body, '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.version = 0
+        self.frame = b""
+        self.step()
+
+    def around(self, spread):
+        return round(self.center[0] + self.random.uniform(-spread, spread), 6), round(self.center[1] + self.random.uniform(-spread, spread), 6)
+
+    def step(self, now=None):
+        rnd, now = self.random, now or time.time()
+        for v in self.vehicles.values():
+            # most vehicles move a little every update; some stand still at stops
+            if rnd.random() < 0.8:
+                v["speed"] = rnd.randrange(5, 60)
+                v["angle"] = (v["angle"] + rnd.randrange(-20, 21)) % 360
+                v["lat"] = round(v["lat"] + 0.0002 * math.cos(math.radians(v["angle"])), 6)
+                v["lon"] = round(v["lon"] + 0.0003 * math.sin(math.radians(v["angle"])), 6)
+            else:
+                v["speed"] = 0
+            v["delay"] = max(-60, v["delay"] + rnd.randrange(-15, 20))
+            v["timestamp"] = now
+        self.version += 1
+        self.frame = f"42/{self.name},".encode() + json.dumps(["vehicles", {"data": self.vehicles}]).encode()
+
+
+class Upstream:
+    def __init__(self, sizes, default_size=200, stops=500, period=5, latency=0, fail_rate=0, drop_rate=0):
+        self.sizes, self.default_size, self.stop_count = sizes, default_size, stops
+        self.period, self.latency, self.fail_rate, self.drop_rate = period, latency, fail_rate, drop_rate
+        self.fleets = {}
+        self.sessions = {}
+        self.changed = threading.Condition()
+        self.stats = {"handshake": 0, "post": 0, "poll": 0, "stops": 0, "not_modified": 0, "failed": 0, "dropped": 0}
+
+    def fleet(self, name):
+        with self.changed:
+            if name not in self.fleets:
+                self.fleets[name] = Fleet(name, self.sizes.get(name, self.default_size), self.stop_count)
+            return self.fleets[name]
+
+    def tick(self):
+        while True:
+            time.sleep(self.period)
+            with self.changed:
+                # one timestamp per tick, so an update can be followed across cities
+                now = time.time()
+                for fleet in self.fleets.values():
+                    fleet.step(now)
+                self.changed.notify_all()
+
+
+class Session:
+    def __init__(self):
+        self.namespaces = {}    # name -> version last sent
+        self.outbox = []
+        self.next_ping = time.time() + PING_INTERVAL / 1000
+
+
+# ---------- HTTP ----------
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers: self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def injected_failure(self):
+        up = self.server.upstream
+        if up.latency: time.sleep(up.latency / 1000)
+        if up.fail_rate and random.random() < up.fail_rate:
+            up.stats["failed"] += 1
+            self.reply(b"upstream failure", 503)
+            return True
+        return False
+
+    def do_GET(self):
+        up, url = self.server.upstream, urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/_stats":
+            return self.reply(json.dumps(up.stats).encode(), headers=[("Content-Type", "application/json")])
+        if self.injected_failure(): return
+        if url.path.startswith("/api/") and url.path.endswith("/transport"):
+            fleet = up.fleet(url.path.split("/")[2])
+            up.stats["stops"] += 1
+            if self.headers.get("If-None-Match") == fleet.stops_etag:
+                up.stats["not_modified"] += 1
+                return self.reply(b"", 304, [("ETag", fleet.stops_etag)])
+            return self.reply(fleet.stops_body, headers=[("Content-Type", "application/json"), ("ETag", fleet.stops_etag)])
+        if url.path != "/socket.io/":
+            return self.reply(b"not found", 404)
+        sid = query.get("sid", [None])[0]
+        if sid is None:
+            sid = uuid.uuid4().hex
+            up.sessions[sid] = Session()
+            up.stats["handshake"] += 1
+            info = {"sid": sid, "upgrades": [], "pingInterval": PING_INTERVAL, "pingTimeout": PING_TIMEOUT, "maxPayload": 1000000}
+            return self.reply(b"0" + json.dumps(info).encode(), headers=[("Content-Type", "text/plain")])
+        session = up.sessions.get(sid)
+        if session is None:
+            return self.reply(b'{"code":1,"message":"Session ID unknown"}', 400)
+        up.stats["poll"] += 1
+        if up.drop_rate and random.random() < up.drop_rate:
+            up.stats["dropped"] += 1
+            up.sessions.pop(sid, None)
+            return self.reply(b"1")
+        self.reply(b"\x1e".join(self.wait_packets(up, session)), headers=[("Content-Type", "text/plain")])
+
+    def wait_packets(self, up, session):
+        # long-poll: answer as soon as there is something to send, like Engine.IO does
+        with up.changed:
+            while True:
+                packets, session.outbox = session.outbox, []
+                for name, sent in session.namespaces.items():
+                    fleet = up.fleets[name]
+                    if fleet.version > sent:
+                        packets.append(fleet.frame)
+                        session.namespaces[name] = fleet.version
+                if time.time() >= session.next_ping:
+                    packets.append(b"2")
+                    session.next_ping += PING_INTERVAL / 1000
+                if packets: return packets
+                up.changed.wait(max(session.next_ping - time.time(), 0.01))
+
+    def do_POST(self):
+        up, url = self.server.upstream, urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.injected_failure(): return
+        session = up.sessions.get(parse_qs(url.query).get("sid", [None])[0])
+        if session is None:
+            return self.reply(b'{"code":1,"message":"Session ID unknown"}', 400)
+        up.stats["post"] += 1
+        for packet in body.split(b"\x1e"):
+            if packet.startswith(b"40/"):
+                name = packet[3:].split(b",")[0].decode()
+                up.fleet(name)
+                with up.changed:
+                    session.namespaces[name] = 0
+                    session.outbox.append(f'40/{name},{{"sid":"{uuid.uuid4().hex}"}}'.encode())
+                    up.changed.notify_all()
+            elif packet == b"1":
+                up.sessions.pop(parse_qs(url.query)["sid"][0], None)
+        self.reply(b"ok", headers=[("Content-Type", "text/plain")])
+
+
+def make_server(port=0, **options):
+    # returns a started-ticker server; call serve_forever() (port 0 picks a free port)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.upstream = Upstream(**options)
+    threading.Thread(target=server.upstream.tick, daemon=True).start()
+    return server
+
+
+def parse_sizes(values):
+    return {name: int(size) for name, size in (v.split("=") for v in values)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake czynaczas.pl upstream")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--vehicles", type=int, default=200, help="vehicles per city")
+    parser.add_argument("--size", action="append", default=[], metavar="CITY=N", help="vehicles for one city")
+    parser.add_argument("--stops", type=int, default=500, help="stops per city")
+    parser.add_argument("--period", type=float, default=5, help="seconds between fleet updates")
+    parser.add_argument("--latency", type=float, default=0, help="ms added to every request")
+    parser.add_argument("--fail-rate", type=float, default=0, help="share of requests answered with 503")
+    parser.add_argument("--drop-rate", type=float, default=0, help="share of polls that close the session")
+    args = parser.parse_args()
+    server = make_server(args.port, sizes=parse_sizes(args.size), default_size=args.vehicles, stops=args.stops,
+                         period=args.period, latency=args.latency, fail_rate=args.fail_rate, drop_rate=args.drop_rate)
+    print(f"🧪 fake czynaczas.pl on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
@@ -0,0 +1,94 @@
+from collections import deque
+from payload import build_payload
+from vehicles import MISSING, NUMERIC
+import threading
+
+HISTORY = 30    # versions kept per city; older clients get a full snapshot
+
+
+# ---------- Versioned vehicle feed ----------
+def diff(old, new):
+    # old, new: VehicleTable; compares column by column and materializes only what changed
+    added, changed = {}, {}
+    for i, vid in enumerate(new.ids):
+        j = old.index.get(vid)
+        if j is None:
+            added[vid] = new.row(i)
+            continue
+        fields = {}
+        for f in NUMERIC:
+            if new.kinds[f][i] != old.kinds[f][j] or new.numbers[f][i] != old.numbers[f][j]:
+                fields[f] = new.value(f, i)
+        for f in new.texts.keys() | old.texts.keys():
+            after, before = new.texts.get(f), old.texts.get(f)
+            if (after[i] if after else MISSING) != (before[j] if before else MISSING):
+                name = f[1:] if f.startswith("\0") else f
+                fields[name] = new.value(name, i)
+        if fields:
+            changed[vid] = {k: (None if v is MISSING else v) for k, v in fields.items()}
+    removed = [vid for vid in old.ids if vid not in new.index]
+    return added, changed, removed
+
+
+def delta(versions, since=None):
+    if not versions:
+        return {"seq": 0, "full": True, "added": {}, "changed": {}, "removed": []}
+    seq, current = versions[-1]
+    base = next((table for s, table in versions if s == since), None)
+    if base is None:
+        return {"seq": seq, "full": True, "added": current.to_dict(), "changed": {}, "removed": []}
+    added, changed, removed = diff(base, current)
+    return {"seq": seq, "full": False, "added": added, "changed": changed, "removed": removed}
+
+
+class DeltaFeed:
+    # Bounded ring of recent snapshots of one city, numbered by a sequence.
+    # Delta payloads are built once per (newest version, since) and shared by every client.
+
+    def __init__(self, size=HISTORY):
+        self.versions = deque(maxlen=size)  # (seq, VehicleTable)
+        self.seq = 0
+        self.payloads = {}
+        self.lock = threading.Lock()
+
+    def push(self, table, seq=None):
+        # seq: the ingest process's number for this version, so every worker hands out the same ones
+        with self.lock:
+            if seq is not None and seq <= self.seq:
+                # numbering started over (a new ingest run): older entries would be read as bases of the new ones
+                self.versions.clear()
+            self.seq = self.seq + 1 if seq is None else seq
+            self.versions.append((self.seq, table))
+            self.payloads = {}
+            return self.seq
+
+    def reset(self):
+        # forget every kept version; the next delta of any client is a full snapshot
+        with self.lock:
+            self.versions.clear()
+            self.payloads = {}
+
+    def resume(self, seq):
+        # continue numbering after seq, e.g. the last version a previous run published
+        with self.lock:
+            self.seq = max(self.seq, seq)
+
+    def delta(self, since=None):
+        with self.lock:
+            versions = list(self.versions)
+        return delta(versions, since)
+
+    def payload(self, since=None):
+        return self.versioned_payload(since)[1]
+
+    def versioned_payload(self, since=None):
+        # returns (seq, payload); the payload cache is swapped together with the ring on push
+        with self.lock:
+            payloads, versions = self.payloads, list(self.versions)
+        seq = versions[-1][0] if versions else 0
+        # every unknown or expired sequence shares the one full snapshot
+        if all(s != since for s, _ in versions): since = None
+        payload = payloads.get(since)
+        if payload is None:
+            payload = payloads[since] = build_payload(delta(versions, since))
+        return seq, payload
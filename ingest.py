@@ -0,0 +1,27 @@
+# The one upstream poller of a multi-worker deployment. It runs json_host's updater and publishes
+# every city snapshot to the shared store in BUS_STORE_DIR; any number of web workers serve from there:
+#
+#   BUS_STORE_DIR=/dev/shm/busproject python ingest.py
+#   BUS_STORE_DIR=/dev/shm/busproject gunicorn -w 8 -k gthread --threads 16 -b 0.0.0.0:5000 json_host:app
+#   BUS_STORE_DIR=/dev/shm/busproject gunicorn -w 2 -k gevent --worker-connections 2000 -b 0.0.0.0:5002 json_host:app
+# (the second group serves only the long-lived _bus_stream connections, see "Running with several workers" in README.md)
+from flask import Flask
+from metrics import instrument
+from shm_store import StoreReader, StoreWriter
+import argparse, threading
+import json_host
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="czynaczas.pl ingester for json_host web workers")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve /metrics of the ingester on this port")
+    args = parser.parse_args()
+    if not json_host.STORE_DIR:
+        raise SystemExit("set BUS_STORE_DIR to the directory shared with the web workers (e.g. /dev/shm/busproject)")
+    json_host.resume_versions(StoreReader(json_host.STORE_DIR))
+    json_host.store = StoreWriter(json_host.STORE_DIR)
+    if args.metrics_port:
+        app = Flask(__name__)
+        instrument(app)
+        threading.Thread(target=app.run, kwargs={"host": "0.0.0.0", "port": args.metrics_port}, daemon=True).start()
+    print(f"📡 ingesting into {json_host.STORE_DIR}")
+    json_host.updater()
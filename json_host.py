@@ -1,10 +1,21 @@
-from flask import Flask, jsonify
-import requests, re, json, time, threading
+from analytics import DelayStats
+from flask import Flask, jsonify, request
+from concurrent.futures import ThreadPoolExecutor
+from engineio import loads
+from feed import DeltaFeed
+from metrics import Gauge, instrument
+from payload import build_payload, serve_payload
+from recorder import RECORD_DIR, Recorder
+from shm_store import StoreReader
+from snapshot import BusSnapshot, bus_clusters, bus_record, empty_buses, empty_stops, payloads_from, stop_clusters, stop_record, stops_snapshot
+from spatial import GridIndex, parse_bbox, parse_float
+from stream import Broadcaster, format_event
+from upstream import BASE, SocketSession, fetch_stops, load_cached_stops, make_headers, stage_seconds
+from vehicles import VehicleTable
+import os, time, threading
 
 app = Flask(__name__)
-
-BASE = "https://czynaczas.pl"
-SOCKET = f"{BASE}/socket.io/?EIO=4&transport=polling"
+instrument(app)
 
 cities = [
     {"name": "zielonagora", "stops_url": f"{BASE}/api/zielonagora/transport", "socket_ns": "zielonagora"},
@@ -23,90 +34,342 @@ cities = [
     {"name": "trojmiasto", "stops_url": f"{BASE}/api/trojmiasto/transport", "socket_ns": "trojmiasto"},
 ]
 
-COOKIE = ""
-latest_buses = {}
-latest_stops = {}
-lock = threading.Lock()
+STOPS_INTERVAL = 3600   # seconds between stop refreshes of one city
+STOPS_RETRY = 60        # seconds before retrying a failed stop refresh
+MAX_CONCURRENCY = 4     # global cap on cities fetched at once (avoid IP ban)
+SESSION_STAGGER = 1     # seconds between opening socket sessions at startup
+BUS_MAX_AGE = 2         # Cache-Control max-age for bus data, upstream changes every 2-15 s
+MAX_NEAR = 100          # cap on results of one nearest-N query
+MAX_TRACK_SPAN = 86400  # longest time range of one vehicle track query, seconds
+STORE_DIR = os.environ.get("BUS_STORE_DIR")     # shared snapshot store of ingest.py, for multi-worker serving
+STATUS_INTERVAL = 1     # seconds between session status exports to the store
+FOLLOW_INTERVAL = 0.1   # seconds between a worker's checks for new versions in the store
+sessions = {}           # city -> SocketSession
+remote_sessions = {}    # city -> session status exported by ingest.py, on web workers
+store = None            # shm_store.StoreWriter when this process is the ingester
+epoch = time.time()     # identifies this run in the store; a worker resets its feed when it changes
 
+# city -> immutable snapshot, replaced as a whole on every update; handlers read them without locking
+bus_snapshots = {c["name"]: empty_buses(c["name"]) for c in cities}
+stop_snapshots = {c["name"]: empty_stops(c["name"]) for c in cities}
+bus_feeds = {c["name"]: DeltaFeed() for c in cities}
+bus_streams = {c["name"]: Broadcaster() for c in cities}
+delay_stats = {c["name"]: DelayStats(c["name"]) for c in cities}
+recorder = Recorder(RECORD_DIR) if RECORD_DIR else None
+
+
+# ---------- Background thread ----------
+def publish_buses(city, buses):
+    name = city["name"]
+    with stage_seconds.time(name, "normalize"):
+        table = VehicleTable.from_buses(buses)
+        if table == bus_snapshots[name].table: return
+        # the upstream dict is serialized once here and then dropped; only the table is kept
+        payload = build_payload({name: buses})
+    now = time.time()
+    # computed once per update here instead of in every client
+    with stage_seconds.time(name, "analytics"):
+        delays, ranked = delay_stats[name].update(table, now)
+    snapshot = install_buses(name, table, payload, now, delays, ranked)
+    if recorder: recorder.record(name, table)
+    if store: store.write(f"{name}.buses", *bus_record(snapshot, epoch))
+
+
+def install_buses(name, table, payload, updated, delays, ranked, version=None, reset=False):
+    # shared by the updater and by web workers following ingest.py; reset: version starts a new numbering
+    index = GridIndex(table.positions())
+    feed = bus_feeds[name]
+    if reset: feed.reset()
+    seq = feed.push(table, version)
+    # table, payload, index and analytics become visible together, with the feed sequence as version
+    snapshot = bus_snapshots[name] = BusSnapshot(seq, table, payload, updated, index, delays, ranked)
+    # one delta per version, serialized once and fanned out to every stream subscriber
+    seq, delta = feed.versioned_payload(seq - 1)
+    bus_streams[name].publish(format_event("buses", delta.raw, seq))
+    return snapshot
 
-# ---------- Fetching ----------
-def fetch_buses_once(city):
-    headers = {"User-Agent": "Mozilla/5.0", "Origin": BASE, "Referer": f"{BASE}/{city['name']}", "Accept": "*/*"}
-    if COOKIE: headers["Cookie"] = COOKIE
-    try:
-        r = requests.get(SOCKET, headers=headers, timeout=6)
-        sid_match = re.search(r'"sid":"([^"]+)"', r.text)
-        if not sid_match: return {}
-        sid = sid_match.group(1)
-        url = f"{SOCKET}&sid={sid}"
-        requests.post(url, headers=headers, data=f'40/{city["socket_ns"]},{{}}', timeout=6)
-        time.sleep(1)
-        r = requests.get(url, headers=headers, timeout=6)
-        if f"42/{city['socket_ns']}" not in r.text: return {}
-        payload = r.text.split(f"42/{city['socket_ns']},")[1]
-        data = json.loads(payload)
-        return data[1].get("data", {})
-    except Exception as e:
-        print(f"[{city['name']}] bus fetch error:", e)
-        return {}
 
+def publish_stops(city, stops):
+    snapshot = stop_snapshots[city["name"]] = stops_snapshot(city["name"], stops)
+    if store: store.write(f"{city['name']}.stops", *stop_record(snapshot))
 
-def fetch_stops(city):
-    headers = {"User-Agent": "Mozilla/5.0", "Origin": BASE, "Referer": f"{BASE}/{city['name']}", "Accept": "*/*"}
-    if COOKIE: headers["Cookie"] = COOKIE
+
+def refresh_stops(city):
+    # runs in the updater's pool; an error here (e.g. a full store) must not end the updater loop
     try:
-        r = requests.get(city["stops_url"], headers=headers, timeout=6)
-        r.raise_for_status()
-        data = r.json()
-        stops = data.get("stops", [])
-        result = []
-        for s in stops:
-            if len(s) >= 4:
-                result.append({
-                    "id": s[0],
-                    "name": s[1],
-                    "lat": s[2],
-                    "lon": s[3],
-                    "stop_name": f"{s[1]} - {s[0]}",
-                    "trip_headsign": s[4] if len(s) > 4 else ""
-                })
-        return result
+        stops = fetch_stops(city)
+        if not stops: return False
+        if stops is not stop_snapshots[city["name"]].stops: publish_stops(city, stops)
+        return True
     except Exception as e:
-        print(f"[{city['name']}] stop fetch error:", e)
-        return []
+        print(f"[{city['name']}] stop refresh error:", e)
+        return False
+
+
+def start_sessions():
+    # buses are pushed over one persistent socket.io session per city
+    for city in cities:
+        session = sessions[city["name"]] = SocketSession(city["socket_ns"], make_headers(city), lambda buses, city=city: publish_buses(city, buses))
+        session.start()
+        time.sleep(SESSION_STAGGER)
+
+
+def export_status():
+    # session state for the workers' status.json; it changes without new bus versions
+    while True:
+        status = {name: [s.last_frame, s.cadence.interval, s.staleness] for name, s in list(sessions.items())}
+        store.write("status", {"sessions": status}, {})
+        time.sleep(STATUS_INTERVAL)
 
 
-# ---------- Background thread ----------
 def updater():
+    if recorder: recorder.start()
+    if store: threading.Thread(target=export_status, daemon=True).start()
+    threading.Thread(target=start_sessions, daemon=True).start()
+    # stops change rarely: serve the disk cache right away and refresh it on its own schedule
+    next_due = {}
+    for city in cities:
+        stops, fetched_at = load_cached_stops(city)
+        if stops: publish_stops(city, stops)
+        next_due[city["name"]] = fetched_at + STOPS_INTERVAL
+    # every city has its own deadline, so one slow city only delays itself
+    pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    running = {}
     while True:
+        now = time.time()
+        for name, future in list(running.items()):
+            if future.done():
+                del running[name]
+                next_due[name] = now + (STOPS_INTERVAL if future.result() else STOPS_RETRY)
         for city in cities:
-            buses = fetch_buses_once(city)
-            stops = fetch_stops(city)
-            with lock:
-                if buses: latest_buses[city["name"]] = buses
-                if stops: latest_stops[city["name"]] = stops
-        time.sleep(10)
+            name = city["name"]
+            if name not in running and next_due[name] <= now and len(running) < MAX_CONCURRENCY:
+                running[name] = pool.submit(refresh_stops, city)
+        time.sleep(0.2)
+
+
+def resume_versions(reader):
+    # an ingester continues the numbers of the previous run, so clients' ?since and stream ids stay valid
+    for city in cities:
+        record = reader.read(f"{city['name']}.buses")
+        if record: bus_feeds[city["name"]].resume(record[1]["version"])
+
+
+# ---------- Web worker side of a multi-process deployment ----------
+def follow_store(reader, seen):
+    while True:
+        time.sleep(FOLLOW_INTERVAL)
+        follow_once(reader, seen)
+
+
+def follow_once(reader, seen):
+    # installs every version ingest.py published since the last call; each is copied out of the store once
+    for city in cities:
+        try:
+            follow_city(reader, city["name"], seen)
+        except Exception as e:
+            print(f"[{city['name']}] store read error:", e)
+    status = reader.read("status")
+    if status: remote_sessions.update(status[1]["sessions"])
+
+
+def follow_city(reader, name, seen):
+    record = reader.read(f"{name}.buses")
+    if record and seen.get(f"{name}.buses") != record[0]:
+        seen[f"{name}.buses"] = record[0]
+        meta, payloads = record[1], payloads_from(record[1]["etags"], record[2])
+        table = VehicleTable.from_buses(loads(payloads["buses"].raw)[name])
+        reset = seen.get(f"{name}.epoch", meta["epoch"]) != meta["epoch"]
+        seen[f"{name}.epoch"] = meta["epoch"]
+        install_buses(name, table, payloads["buses"], meta["updated"], payloads["delays"], payloads["ranked"], meta["version"], reset)
+    record = reader.read(f"{name}.stops")
+    if record and seen.get(f"{name}.stops") != record[0]:
+        seen[f"{name}.stops"] = record[0]
+        payload = payloads_from(record[1]["etags"], record[2])["stops"]
+        stop_snapshots[name] = stops_snapshot(name, loads(payload.raw)[name], record[1]["version"], payload)
+
+
+follower_pid = None     # process that follows the store; a forked worker starts its own
+follower_lock = threading.Lock()
+
+
+@app.before_request
+def start_follower():
+    global follower_pid
+    if not STORE_DIR or store or follower_pid == os.getpid(): return
+    with follower_lock:
+        if follower_pid == os.getpid(): return
+        # the first pass runs here, so even the first request sees the current data
+        reader, seen = StoreReader(STORE_DIR), {}
+        follow_once(reader, seen)
+        threading.Thread(target=follow_store, args=(reader, seen), daemon=True).start()
+        follower_pid = os.getpid()
+
+
+def seconds_since(t):
+    return round(time.time() - t, 1) if t else None
+
+
+def city_status(name):
+    # age: since upstream last confirmed the data, changed: since it last changed,
+    # interval: learned update cadence, staleness: average delay between upstream push and our fetch
+    session = sessions.get(name)
+    if session:
+        last_frame, interval, staleness = session.last_frame, session.cadence.interval, session.staleness
+    else:
+        last_frame, interval, staleness = remote_sessions.get(name, (None, None, None))
+    buses = bus_snapshots[name]
+    return {
+        "age": seconds_since(last_frame),
+        "changed": seconds_since(buses.updated),
+        "interval": round(interval, 1) if interval else None,
+        "staleness": round(staleness, 2) if staleness is not None else None,
+        "version": buses.version,
+        "buses": len(buses.table),
+        "stops": len(stop_snapshots[name].stops),
+    }
+
+
+def per_city(field):
+    return lambda: {(c["name"],): city_status(c["name"])[field] for c in cities}
+
+
+Gauge("city_data_age_seconds", "Seconds since upstream last sent bus data", ("city",), per_city("age"))
+Gauge("city_data_changed_seconds", "Seconds since the bus data last changed", ("city",), per_city("changed"))
+Gauge("city_upstream_staleness_seconds", "Average time a frame waited upstream before it was fetched", ("city",), per_city("staleness"))
+Gauge("city_vehicles", "Vehicles in the latest snapshot", ("city",), per_city("buses"))
+Gauge("city_stops", "Stops currently served", ("city",), per_city("stops"))
+Gauge("city_version", "Version of the bus snapshot being served", ("city",), per_city("version"))
+Gauge("city_stream_subscribers", "Open bus event streams", ("city",), lambda: {(name,): len(b.subscribers) for name, b in bus_streams.items()})
+Gauge("recorder_dropped_total", "Snapshots dropped because the history writer fell behind", (), lambda: {(): recorder.dropped} if recorder else {})
 
 
 # ---------- JSON endpoints ----------
 @app.route("/busproject/<city>_bus_data.json")
 def get_city_buses(city):
-    if city not in [c["name"] for c in cities]:
+    snapshot = bus_snapshots.get(city)
+    if snapshot is None:
         return jsonify({"error": "unknown city"}), 404
-    with lock:
-        return jsonify({city: latest_buses.get(city, {})})
+    if "bbox" in request.args:
+        try:
+            bbox = parse_bbox(request.args["bbox"])
+        except ValueError:
+            return jsonify({"error": "bbox must be south,west,north,east"}), 400
+        table = snapshot.table
+        return jsonify({city: {table.ids[i]: table.row(i) for i in snapshot.index.bbox(*bbox)}})
+    return serve_payload(snapshot.payload, BUS_MAX_AGE)
+
+
+@app.route("/busproject/<city>_bus_delta.json")
+def get_city_bus_delta(city):
+    feed = bus_feeds.get(city)
+    if feed is None:
+        return jsonify({"error": "unknown city"}), 404
+    return serve_payload(feed.payload(request.args.get("since", type=int)), BUS_MAX_AGE)
+
+
+@app.route("/busproject/<city>_bus_stream")
+def get_city_bus_stream(city):
+    feed = bus_feeds.get(city)
+    if feed is None:
+        return jsonify({"error": "unknown city"}), 404
+    # a reconnecting EventSource sends Last-Event-ID; the first connection may pass ?since=
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None: since = request.args.get("since", type=int)
+    def snapshot():
+        seq, payload = feed.versioned_payload(since)
+        return [format_event("buses", payload.raw, seq)]
+    return bus_streams[city].response(snapshot)
 
 
 @app.route("/busproject/<city>_stop.json")
 def get_city_stops(city):
-    if city not in [c["name"] for c in cities]:
+    snapshot = stop_snapshots.get(city)
+    if snapshot is None:
+        return jsonify({"error": "unknown city"}), 404
+    if "bbox" in request.args:
+        try:
+            bbox = parse_bbox(request.args["bbox"])
+        except ValueError:
+            return jsonify({"error": "bbox must be south,west,north,east"}), 400
+        return jsonify({city: snapshot.index.bbox(*bbox)})
+    # the placeholder before the first load must not be cached for an hour
+    return serve_payload(snapshot.payload, STOPS_INTERVAL if snapshot.version else 0)
+
+
+@app.route("/busproject/<city>_near.json")
+def get_city_near(city):
+    if city not in stop_snapshots:
         return jsonify({"error": "unknown city"}), 404
-    with lock:
-        return jsonify({city: latest_stops.get(city, [])})
+    try:
+        lat, lon = parse_float(request.args["lat"]), parse_float(request.args["lon"])
+        n = min(int(request.args.get("n", 10)), MAX_NEAR)
+        radius = parse_float(request.args["radius"]) if "radius" in request.args else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat and lon are required, n and radius must be numbers"}), 400
+    if request.args.get("type", "stops") == "buses":
+        snapshot = bus_snapshots[city]
+        table = snapshot.table
+        found = [{"id": table.ids[i], "distance": round(d), **table.row(i)} for d, i in snapshot.index.nearest(lat, lon, n, radius)]
+    else:
+        found = [{"distance": round(d), **s} for d, s in stop_snapshots[city].index.nearest(lat, lon, n, radius)]
+    return jsonify({city: found})
+
+
+@app.route("/busproject/<city>_clusters.json")
+def get_city_clusters(city):
+    if city not in bus_snapshots:
+        return jsonify({"error": "unknown city"}), 404
+    try:
+        zoom, bbox = int(request.args["zoom"]), parse_bbox(request.args["bbox"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "zoom and bbox=south,west,north,east are required"}), 400
+    if request.args.get("type", "stops") == "buses":
+        return jsonify({city: bus_clusters(bus_snapshots[city], zoom, bbox)})
+    return jsonify({city: stop_clusters(stop_snapshots[city], zoom, bbox)})
+
+
+@app.route("/busproject/<city>_delays.json")
+def get_city_delays(city):
+    snapshot = bus_snapshots.get(city)
+    if snapshot is None:
+        return jsonify({"error": "unknown city"}), 404
+    return serve_payload(snapshot.ranked if "ranked" in request.args else snapshot.delays, BUS_MAX_AGE)
+
+
+@app.route("/busproject/<city>_history.json")
+def get_city_history(city):
+    if city not in bus_feeds or not recorder:
+        return jsonify({"error": "no history for this city"}), 404
+    at = request.args.get("at", type=float)
+    if at is None:
+        return jsonify({"error": "at must be a unix timestamp"}), 400
+    recorded_at, buses = recorder.state_at(city, at)
+    if buses is None:
+        return jsonify({"error": "nothing recorded at that time"}), 404
+    return jsonify({"t": recorded_at, city: buses})
+
+
+@app.route("/busproject/<city>_track.json")
+def get_city_track(city):
+    if city not in bus_feeds or not recorder:
+        return jsonify({"error": "no history for this city"}), 404
+    vehicle = request.args.get("vehicle")
+    end = request.args.get("to", time.time(), type=float)
+    start = request.args.get("from", end - 3600, type=float)
+    if not vehicle or not 0 <= end - start <= MAX_TRACK_SPAN:
+        return jsonify({"error": f"vehicle is required and from..to may span at most {MAX_TRACK_SPAN} s"}), 400
+    return jsonify({"vehicle": vehicle, "points": recorder.track(city, vehicle, start, end)})
+
+
+@app.route("/busproject/status.json")
+def get_status():
+    return jsonify({c["name"]: city_status(c["name"]) for c in cities})
 
 
 # ---------- Start ----------
 if __name__ == "__main__":
-    threading.Thread(target=updater, daemon=True).start()
+    # with BUS_STORE_DIR set the data comes from ingest.py, see start_follower
+    if not STORE_DIR: threading.Thread(target=updater, daemon=True).start()
     print("🌍 JSON server running on http://0.0.0.0:5000")
     app.run(host="0.0.0.0", port=5000, threaded=True)
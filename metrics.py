@@ -0,0 +1,139 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, g, request
+import threading, time
+
+# seconds; covers a parse of a few ms up to a long-poll held for a whole ping interval
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def label_text(names, values, extra=""):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# ---------- Metric types (Prometheus text format, no client library needed) ----------
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}    # label values tuple -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        return self.header() + [f"{self.name}{label_text(self.labels, key)} {value}" for key, value in self.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    # set() by the owner, or collect() -> {label values: value} called on every scrape
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.collect: return [(k, v) for k, v in self.collect().items() if v is not None]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # per-bucket counts (not cumulative yet), sum, count
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        with self.lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = self.header()
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_text(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{label_text(self.labels, key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Shared instruments ----------
+request_seconds = Histogram("http_request_duration_seconds", "Time to produce a response, per route", ("route", "method", "status"))
+
+
+def instrument(app):
+    # request latency for every route, plus GET /metrics
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            # the route pattern, not the path, keeps the label set bounded
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            request_seconds.observe(time.perf_counter() - started, route, request.method, response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def get_metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
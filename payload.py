@@ -0,0 +1,38 @@
+from collections import namedtuple
+from flask import Response, request
+import gzip, hashlib, json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# One JSON document serialized once, kept raw and compressed, with its content hash.
+Payload = namedtuple("Payload", "raw gzip br etag")
+
+
+def build_payload(obj):
+    raw = json.dumps(obj, separators=(",", ":")).encode()
+    return Payload(
+        raw,
+        gzip.compress(raw, 5),
+        brotli.compress(raw, quality=5) if brotli else None,
+        hashlib.sha1(raw).hexdigest(),
+    )
+
+
+def serve_payload(payload, max_age):
+    if request.if_none_match.contains(payload.etag):
+        resp = Response(status=304)
+    elif payload.br and "br" in request.accept_encodings:
+        resp = Response(payload.br, mimetype="application/json")
+        resp.headers["Content-Encoding"] = "br"
+    elif "gzip" in request.accept_encodings:
+        resp = Response(payload.gzip, mimetype="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(payload.raw, mimetype="application/json")
+    resp.set_etag(payload.etag)
+    resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
@@ -0,0 +1,150 @@
+from calendar import timegm
+from feed import diff
+import gzip, json, os, queue, threading, time, zlib
+
+RECORD_DIR = os.environ.get("BUS_RECORD_DIR")     # recording is off unless this is set
+RETENTION = int(os.environ.get("BUS_RECORD_RETENTION_HOURS", 24 * 7)) * 3600
+SEGMENT = 3600          # one segment file per city per hour (UTC)
+KEYFRAME_EVERY = 60     # full snapshot every N records, bounds replay work inside a segment
+FLUSH_INTERVAL = 10     # seconds; flushed data is readable by replay while the segment is open
+QUEUE_SIZE = 1000       # snapshots waiting for the writer; beyond that they are dropped, never blocking
+
+
+# ---------- Reading ----------
+def read_segment(path):
+    # streams records; stops quietly at the unflushed or torn tail of a segment still being written
+    try:
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"): return
+                yield json.loads(line)
+    except (EOFError, OSError, zlib.error, ValueError):
+        return
+
+
+def apply(state, record):
+    if record.get("full"): return dict(record["vehicles"])
+    state.update(record["added"])
+    for vid, fields in record["changed"].items():
+        if vid in state: state[vid] = {**state[vid], **fields}
+    for vid in record["removed"]:
+        state.pop(vid, None)
+    return state
+
+
+def vehicle_after(bus, vid, record):
+    # one vehicle's state after record, without rebuilding the whole city
+    if record.get("full"): return record["vehicles"].get(vid)
+    if vid in record["added"]: return record["added"][vid]
+    if vid in record["changed"] and bus is not None: return {**bus, **record["changed"][vid]}
+    if vid in record["removed"]: return None
+    return bus
+
+
+# ---------- Append-only segmented recorder ----------
+class Segment:
+    __slots__ = ("file", "start", "records", "last")
+
+    def __init__(self, path, start):
+        self.file = gzip.open(path, "ab")
+        self.start = start
+        self.records = 0
+        self.last = None
+
+
+class Recorder:
+    # Snapshots are queued by the publisher and written by one background thread as
+    # gzip JSON lines: a keyframe, then deltas. Files are <root>/<city>/<UTC start>.jsonl.gz.
+
+    def __init__(self, root, retention=RETENTION):
+        self.root = root
+        self.retention = retention
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.segments = {}
+        self.dropped = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def record(self, city, table, t=None):
+        try:
+            self.queue.put_nowait((city, table, t or time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                city, table, t = self.queue.get(timeout=FLUSH_INTERVAL)
+                self.write(city, table, t)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"[{city}] history write error:", e)
+            if time.time() - last_flush >= FLUSH_INTERVAL:
+                for segment in self.segments.values():
+                    segment.file.flush()
+                last_flush = time.time()
+
+    def write(self, city, table, t):
+        segment = self.segments.get(city)
+        if segment is None or t // SEGMENT != segment.start // SEGMENT:
+            segment = self.roll(city, t)
+        if segment.records % KEYFRAME_EVERY == 0:
+            record = {"t": t, "full": True, "vehicles": table.to_dict()}
+        else:
+            added, changed, removed = diff(segment.last, table)
+            record = {"t": t, "added": added, "changed": changed, "removed": removed}
+        segment.file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        segment.records += 1
+        segment.last = table
+
+    def roll(self, city, t):
+        old = self.segments.pop(city, None)
+        if old: old.file.close()
+        directory = os.path.join(self.root, city)
+        os.makedirs(directory, exist_ok=True)
+        # a new file per start (also after a restart) so a torn tail is never followed by more data
+        path = os.path.join(directory, time.strftime("%Y%m%d%H%M%S", time.gmtime(t)) + ".jsonl.gz")
+        segment = self.segments[city] = Segment(path, t)
+        for start, old_path in self.segment_files(city):
+            if start + SEGMENT < t - self.retention: os.remove(old_path)
+        return segment
+
+    def segment_files(self, city):
+        # [(start, path)] oldest first; the file names are the time index
+        directory = os.path.join(self.root, city)
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.endswith(".jsonl.gz"))
+        except FileNotFoundError:
+            return []
+        return [(timegm(time.strptime(n[:14], "%Y%m%d%H%M%S")), os.path.join(directory, n)) for n in names]
+
+    def state_at(self, city, t):
+        # (time of the record in effect at t, vehicles) or (None, None)
+        files = [path for start, path in self.segment_files(city) if start <= t]
+        # a segment that was just started can still be empty or unflushed; the one before it covers t then
+        for path in reversed(files):
+            at, state = None, None
+            for record in read_segment(path):
+                if record["t"] > t: break
+                state, at = apply(state, record), record["t"]
+            if state is not None: return at, state
+        return None, None
+
+    def track(self, city, vid, t0, t1):
+        files = self.segment_files(city)
+        points = []
+        for k, (start, path) in enumerate(files):
+            end = files[k + 1][0] if k + 1 < len(files) else float("inf")
+            if end <= t0 or start > t1: continue
+            bus = None
+            for record in read_segment(path):
+                if record["t"] > t1: break
+                bus = vehicle_after(bus, vid, record)
+                if bus is None or record["t"] < t0: continue
+                point = {"t": record["t"], **{f: bus.get(f) for f in ("lat", "lon", "angle", "speed", "delay")}}
+                if not points or any(points[-1][f] != point[f] for f in point if f != "t"):
+                    points.append(point)
+        return points
@@ -0,0 +1,114 @@
+import json, mmap, os, struct, time
+
+# One mmap'd file per record: a seqlock header, then the body.
+# The sequence is odd while the writer is inside a record, and every publish adds 2.
+HEADER = struct.Struct("<8sQQ")     # magic, sequence, body length
+MAGIC = b"BUSSTOR1"
+META = struct.Struct("<I")          # body: meta JSON length, meta JSON, blobs
+MIN_SIZE = 1 << 16
+READ_RETRIES = 100
+
+
+def pack(meta, blobs):
+    # meta: JSON-able dict; blobs: name -> bytes, located through meta["parts"]
+    parts, offset = {}, 0
+    for name, blob in blobs.items():
+        parts[name] = (offset, len(blob))
+        offset += len(blob)
+    head = json.dumps({**meta, "parts": parts}, separators=(",", ":")).encode()
+    return b"".join([META.pack(len(head)), head, *blobs.values()])
+
+
+def unpack(buffer, start, length):
+    # -> (meta, blobs) of the body at buffer[start:start + length]; each blob is copied straight out of
+    # the buffer, so it is the only copy taken. ValueError when the body is torn (validated by the caller).
+    end = start + length
+    (size,) = META.unpack_from(buffer, start)
+    if META.size + size > length: raise ValueError("meta beyond the body")
+    meta = json.loads(buffer[start + META.size:start + META.size + size])
+    start += META.size + size
+    blobs = {}
+    for name, (offset, blob_length) in meta.pop("parts").items():
+        if start + offset + blob_length > end: raise ValueError("blob beyond the body")
+        blobs[name] = buffer[start + offset:start + offset + blob_length]
+    return meta, blobs
+
+
+# ---------- Writer (the single ingest process) ----------
+class StoreWriter:
+    def __init__(self, root):
+        self.root = root
+        self.maps = {}  # name -> (file, mmap)
+        os.makedirs(root, exist_ok=True)
+
+    def open(self, name, size):
+        current = self.maps.get(name)
+        if current and len(current[1]) >= size: return current[1]
+        path = os.path.join(self.root, name)
+        f = current[0] if current else open(path, "a+b")
+        capacity = max(MIN_SIZE, 1 << (size - 1).bit_length())
+        # the file only ever grows, so a reader's older and shorter mapping stays valid until it remaps
+        if os.fstat(f.fileno()).st_size < capacity: os.ftruncate(f.fileno(), capacity)
+        if current: current[1].close()
+        mm = mmap.mmap(f.fileno(), 0)
+        if mm[:len(MAGIC)] != MAGIC: HEADER.pack_into(mm, 0, MAGIC, 0, 0)
+        self.maps[name] = (f, mm)
+        return mm
+
+    def write(self, name, meta, blobs):
+        body = pack(meta, blobs)
+        mm = self.open(name, HEADER.size + len(body))
+        _, seq, _ = HEADER.unpack_from(mm)
+        seq += seq % 2  # a writer that died inside a record left it odd
+        HEADER.pack_into(mm, 0, MAGIC, seq + 1, 0)
+        mm[HEADER.size:HEADER.size + len(body)] = body
+        HEADER.pack_into(mm, 0, MAGIC, seq + 1, len(body))
+        HEADER.pack_into(mm, 0, MAGIC, seq + 2, len(body))
+
+
+# ---------- Reader (any number of web workers) ----------
+class StoreReader:
+    # read() costs one header read while nothing changed; a new version is copied out once
+    # and validated against the sequence, so a reader never blocks the writer or sees a torn record.
+
+    def __init__(self, root):
+        self.root = root
+        self.maps = {}      # name -> mmap
+        self.cache = {}     # name -> (sequence, meta, blobs)
+
+    def mapping(self, name, size=0):
+        mm = self.maps.get(name)
+        if mm is not None and len(mm) >= size: return mm
+        try:
+            with open(os.path.join(self.root, name), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        old = self.maps.get(name)
+        if old is not None: old.close()
+        self.maps[name] = mm
+        return mm
+
+    def read(self, name):
+        # -> (sequence, meta, blobs), or None before the first publish
+        cached = self.cache.get(name)
+        for _ in range(READ_RETRIES):
+            mm = self.mapping(name)
+            if mm is None or len(mm) < HEADER.size: return cached
+            magic, seq, length = HEADER.unpack_from(mm)
+            if magic != MAGIC or seq == 0: return cached
+            if cached and cached[0] == seq: return cached
+            if seq % 2:
+                time.sleep(0)
+                continue
+            if HEADER.size + length > len(mm):
+                self.mapping(name, HEADER.size + length)
+                continue
+            try:
+                meta, blobs = unpack(mm, HEADER.size, length)
+            except (ValueError, TypeError, KeyError, AttributeError, struct.error):
+                meta = None     # overwritten while being read; the sequence check below retries
+            if HEADER.unpack_from(mm)[1] != seq or meta is None: continue
+            cached = self.cache[name] = (seq, meta, blobs)
+            return cached
+        return cached
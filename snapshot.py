@@ -0,0 +1,68 @@
+from analytics import empty as empty_delays
+from collections import namedtuple
+from itertools import count
+from payload import Payload, build_payload
+from spatial import GridIndex, cluster_json
+from vehicles import EMPTY
+
+# Immutable per-city state. A writer builds a complete new snapshot and publishes it with one
+# dict assignment; a reader takes the reference once and never sees a half-updated city.
+# version: feed sequence of the bus table / running number of the stop list; updated: unix time;
+# delays, ranked: analytics.DelayStats payloads computed from the same table
+BusSnapshot = namedtuple("BusSnapshot", "version table payload updated index delays ranked", defaults=(None, None, None))
+StopSnapshot = namedtuple("StopSnapshot", "version stops payload index")
+
+stop_versions = count(1)    # next() is atomic, so concurrent stop writers never share a number
+
+
+def empty_buses(name):
+    return BusSnapshot(0, EMPTY, build_payload({name: {}}), None, GridIndex([]), *empty_delays(name))
+
+
+def empty_stops(name):
+    return StopSnapshot(0, [], build_payload({name: []}), GridIndex([]))
+
+
+def stops_snapshot(name, stops, version=None, payload=None):
+    index = GridIndex((s["lat"], s["lon"], s) for s in stops)
+    return StopSnapshot(version or next(stop_versions), stops, payload or build_payload({name: stops}), index)
+
+
+# ---------- Map clusters (zoom and bbox) ----------
+def bus_clusters(snapshot, zoom, bbox):
+    table = snapshot.table
+    def summary(rows):
+        delay = table.mean("delay", rows)
+        return {"delay": None if delay is None else round(delay, 1)}
+    return cluster_json(snapshot.index.clustered(zoom, *bbox), lambda i: {"id": table.ids[i], **table.row(i)}, summary)
+
+
+def stop_clusters(snapshot, zoom, bbox):
+    return cluster_json(snapshot.index.clustered(zoom, *bbox), lambda stop: stop)
+
+
+# ---------- Shared store records (shm_store.py) ----------
+def payload_record(payloads):
+    # {key: Payload} -> (etags, blobs)
+    etags, blobs = {}, {}
+    for key, payload in payloads.items():
+        etags[key] = payload.etag
+        blobs[f"{key}.raw"], blobs[f"{key}.gzip"] = payload.raw, payload.gzip
+        if payload.br is not None: blobs[f"{key}.br"] = payload.br
+    return etags, blobs
+
+
+def payloads_from(etags, blobs):
+    return {key: Payload(blobs[f"{key}.raw"], blobs[f"{key}.gzip"], blobs.get(f"{key}.br"), etag) for key, etag in etags.items()}
+
+
+def bus_record(snapshot, epoch):
+    # the table and index are rebuilt from the raw payload by each reader, they are not serialized;
+    # epoch: start of the ingest run, versions of different runs are never diffed against each other
+    etags, blobs = payload_record({"buses": snapshot.payload, "delays": snapshot.delays, "ranked": snapshot.ranked})
+    return {"version": snapshot.version, "epoch": epoch, "updated": snapshot.updated, "etags": etags}, blobs
+
+
+def stop_record(snapshot):
+    etags, blobs = payload_record({"stops": snapshot.payload})
+    return {"version": snapshot.version, "etags": etags}, blobs
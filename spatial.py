@@ -0,0 +1,143 @@
+from collections import namedtuple
+import math
+
+CELL = 0.01             # grid cell size in degrees (~1.1 km north-south)
+EARTH_RADIUS = 6371000  # metres
+CLUSTER_PX = 60         # points closer than about this many screen pixels are merged
+CLUSTER_UNTIL = 16      # from this map zoom on every point is returned on its own
+TILE = 256              # web map tile size in pixels
+
+Cluster = namedtuple("Cluster", "lat lon items")
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # haversine, metres
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def parse_float(text):
+    # float() also takes "nan" and "inf", which no grid cell can hold
+    value = float(text)
+    if not math.isfinite(value): raise ValueError(f"not a finite number: {text}")
+    return value
+
+
+def parse_bbox(text):
+    # "south,west,north,east" -> tuple of floats, ValueError when malformed
+    south, west, north, east = (parse_float(v) for v in text.split(","))
+    if south > north or west > east: raise ValueError("bbox must be south,west,north,east")
+    return south, west, north, east
+
+
+def cluster_json(clusters, single, summary=None):
+    # a lone point as single(item), otherwise centre and size plus summary(items)
+    return [single(c.items[0]) if len(c.items) == 1 else
+            {"lat": round(c.lat, 6), "lon": round(c.lon, 6), "count": len(c.items), **(summary(c.items) if summary else {})}
+            for c in clusters]
+
+
+def cluster_points(points, zoom, lat):
+    # (lat, lon, item) -> (lat, lon, Cluster) per screen cell of CLUSTER_PX at zoom (web mercator)
+    lon_cell = CLUSTER_PX * 360 / (TILE * 2 ** zoom)
+    lat_cell = lon_cell * math.cos(math.radians(lat))
+    groups = {}
+    for plat, plon, item in points:
+        groups.setdefault((math.floor(plat / lat_cell), math.floor(plon / lon_cell)), []).append((plat, plon, item))
+    for members in groups.values():
+        clat = sum(m[0] for m in members) / len(members)
+        clon = sum(m[1] for m in members) / len(members)
+        yield clat, clon, Cluster(clat, clon, [m[2] for m in members])
+
+
+# ---------- Uniform grid index ----------
+class GridIndex:
+    # Immutable once built; rebuilt whenever a city's stops or buses change.
+
+    def __init__(self, points, cell=CELL):
+        # points: iterable of (lat, lon, item); entries without coordinates are skipped
+        self.cell = cell
+        self.cells = {}
+        self.size = 0
+        for lat, lon, item in points:
+            if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)): continue
+            self.cells.setdefault(self.key(lat, lon), []).append((lat, lon, item))
+            self.size += 1
+        keys = self.cells.keys()
+        self.bounds = (min(k[0] for k in keys), min(k[1] for k in keys), max(k[0] for k in keys), max(k[1] for k in keys)) if keys else None
+        self.clusters = {}  # zoom -> GridIndex of Cluster, built on first use
+
+    def key(self, lat, lon):
+        return int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell))
+
+    def bbox(self, south, west, north, east):
+        return [item for _, _, item in self.bbox_points(south, west, north, east)]
+
+    def bbox_points(self, south, west, north, east):
+        if not self.bounds: return []
+        y0, x0 = self.key(south, west)
+        y1, x1 = self.key(north, east)
+        y0, x0 = max(y0, self.bounds[0]), max(x0, self.bounds[1])
+        y1, x1 = min(y1, self.bounds[2]), min(x1, self.bounds[3])
+        result = []
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                for lat, lon, item in self.cells.get((y, x), ()):
+                    if south <= lat <= north and west <= lon <= east:
+                        result.append((lat, lon, item))
+        return result
+
+    def ring(self, cy, cx, r):
+        # cells at Chebyshev distance r from (cy, cx), clipped to the occupied bounds
+        y0, x0, y1, x1 = self.bounds
+        if r == 0:
+            yield cy, cx
+            return
+        left, right = max(cx - r, x0), min(cx + r, x1)
+        for y in (cy - r, cy + r):
+            if y0 <= y <= y1:
+                for x in range(left, right + 1): yield y, x
+        top, bottom = max(cy - r + 1, y0), min(cy + r - 1, y1)
+        for x in (cx - r, cx + r):
+            if x0 <= x <= x1:
+                for y in range(top, bottom + 1): yield y, x
+
+    def nearest(self, lat, lon, n=10, radius=None):
+        # [(distance, item)] closest first, optionally limited to radius metres
+        if not self.bounds or n <= 0: return []
+        cy, cx = self.key(lat, lon)
+        y0, x0, y1, x1 = self.bounds
+        # every cell outside ring r is at least r cells away along the narrower (longitude) side
+        cell_m = math.radians(self.cell) * EARTH_RADIUS * max(math.cos(math.radians(lat)), 0.01)
+        # rings that do not reach the occupied area are skipped
+        first_r = max(0, y0 - cy, cy - y1, x0 - cx, cx - x1)
+        last_r = max(abs(cy - y0), abs(cy - y1), abs(cx - x0), abs(cx - x1))
+        found = []
+        for r in range(first_r, last_r + 1):
+            if radius is not None and radius < (r - 1) * cell_m: break
+            for key in self.ring(cy, cx, r):
+                for plat, plon, item in self.cells.get(key, ()):
+                    d = distance(lat, lon, plat, plon)
+                    if radius is None or d <= radius:
+                        found.append((d, item))
+            found.sort(key=lambda f: f[0])
+            del found[n:]
+            if len(found) == n and found[-1][0] <= r * cell_m: break
+        return found
+
+    def within(self, lat, lon, radius):
+        return self.nearest(lat, lon, self.size, radius)
+
+    def clustered(self, zoom, south, west, north, east):
+        # [Cluster] inside the bbox; at CLUSTER_UNTIL and closer every point is its own cluster
+        zoom = max(0, min(int(zoom), CLUSTER_UNTIL))
+        if zoom == CLUSTER_UNTIL:
+            return [Cluster(lat, lon, [item]) for lat, lon, item in self.bbox_points(south, west, north, east)]
+        index = self.clusters.get(zoom)
+        if index is None:
+            # once per zoom level for the life of this (immutable) index
+            middle = (self.bounds[0] + self.bounds[2] + 1) / 2 * self.cell if self.bounds else 0
+            points = (p for cell in self.cells.values() for p in cell)
+            index = self.clusters[zoom] = GridIndex(cluster_points(points, zoom, middle), self.cell)
+        return index.bbox(south, west, north, east)
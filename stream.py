@@ -0,0 +1,70 @@
+from flask import Response
+import queue, threading
+
+QUEUE_SIZE = 16     # events buffered per subscriber before it counts as too slow
+KEEPALIVE = 15      # seconds of silence before a comment line keeps proxies from closing the stream
+
+
+# ---------- Server-Sent Events fan-out ----------
+def format_event(event, data, seq=None):
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {event}\ndata: ".encode() + data + b"\n\n"
+
+
+class Broadcaster:
+    # Every event is serialized once by the publisher and queued to all subscribers.
+    # A subscriber whose queue is full is evicted; its EventSource reconnects with Last-Event-ID.
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(self.queue_size)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                self.evict(q)
+
+    def evict(self, q):
+        self.unsubscribe(q)
+        try:
+            while True: q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(None)
+
+    def stream(self, q, first=()):
+        try:
+            yield from first
+            while True:
+                try:
+                    event = q.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None: return
+                yield event
+        finally:
+            self.unsubscribe(q)
+
+    def response(self, snapshot):
+        # subscribe before snapshot() builds the initial events, so no update falls in between
+        q = self.subscribe()
+        resp = Response(self.stream(q, snapshot()), mimetype="text/event-stream")
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.headers["X-Accel-Buffering"] = "no"
+        return resp
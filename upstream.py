@@ -0,0 +1,320 @@
+from engineio import CLOSE, CONNECT_ERROR, DISCONNECT, EVENT, MESSAGE, OPEN, PING, decode_payload, loads
+from metrics import Counter, Histogram
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+import requests, json, os, time, random, threading
+
+BASE = os.environ.get("CZYNACZAS_BASE", "https://czynaczas.pl")     # fake_upstream.py for local runs
+SOCKET = f"{BASE}/socket.io/?EIO=4&transport=polling"
+
+COOKIE = ""
+TIMEOUT = (3.05, 6)     # (connect, read) seconds for every plain request
+STOP_CACHE_DIR = os.environ.get("STOP_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stop_cache"))
+POOL_SIZE = 24          # keep-alive connections kept per host (14 long-polls + stop fetches)
+MAX_BACKOFF = 60
+REQUEST_RATE = 4        # global upstream requests per second, all sessions and stop fetches together
+REQUEST_BURST = 8
+POLL_LEAD = 1           # seconds before an expected change to have the long-poll waiting
+NIGHT_HOURS = range(0, 5)
+NIGHT_FACTOR = 3        # polls are spread this much further apart at night
+BAN_STATUSES = (403, 429)   # what czynaczas.pl / its CDN answer with when we ask too often
+VEHICLES_EVENT = b'["vehicles",'    # start of the one socket.io event that carries bus data
+
+stage_seconds = Histogram("upstream_stage_seconds", "Time per ingest stage (handshake, connect, frame_wait, parse, normalize, analytics, stops_fetch, stops_parse)", ("city", "stage"))
+upstream_errors = Counter("upstream_errors_total", "Failed upstream exchanges by exception type", ("city", "error"))
+ban_signals = Counter("upstream_ban_signals_total", "Upstream answers that look like rate limiting or a ban", ("city", "status"))
+
+
+# ---------- Shared HTTP client ----------
+class BudgetRetry(Retry):
+    # a retry is one more upstream request, so it waits for a budget token like the first attempt did
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)  # raises MaxRetryError once the retries are used up
+        budget.take()
+        return retry
+
+
+def make_client():
+    client = requests.Session()
+    # only idempotent GETs are retried; long-poll read timeouts are left to the session loop
+    retries = BudgetRetry(total=2, read=0, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods={"GET"})
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, max_retries=retries)
+    client.mount("https://", adapter)
+    client.mount("http://", adapter)
+    # gzip/deflate, plus br/zstd when urllib3 can decode them
+    client.headers.update({"User-Agent": "Mozilla/5.0", "Origin": BASE, "Accept": "*/*", "Accept-Encoding": ACCEPT_ENCODING})
+    return client
+
+
+http = make_client()
+
+
+class TokenBucket:
+    # Global request budget; take() blocks until a request may go out.
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+budget = TokenBucket(REQUEST_RATE, REQUEST_BURST)
+
+
+def check_response(city, r):
+    if r.status_code in BAN_STATUSES: ban_signals.inc(city, r.status_code)
+    r.raise_for_status()
+
+
+def make_headers(city):
+    headers = {"Referer": city.get("referer", f"{BASE}/{city['name']}")}
+    if COOKIE: headers["Cookie"] = COOKIE
+    return headers
+
+
+# ---------- Stops ----------
+stop_validators = {}    # stops_url -> (etag, last_modified, parsed stops)
+
+
+def stop_cache_path(city):
+    return os.path.join(STOP_CACHE_DIR, f"{city['name']}.json")
+
+
+def load_cached_stops(city):
+    # returns (stops, fetched_at) from disk and primes the validators for a conditional refresh
+    path = stop_cache_path(city)
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        fetched_at = os.path.getmtime(path)
+    except (OSError, ValueError):
+        return [], 0
+    stop_validators[city["stops_url"]] = (cached.get("etag"), cached.get("last_modified"), cached["stops"])
+    return cached["stops"], fetched_at
+
+
+def save_cached_stops(city, etag, last_modified, stops):
+    # the cache only speeds up the next start; failing to write it must not cost the fetched list
+    try:
+        os.makedirs(STOP_CACHE_DIR, exist_ok=True)
+        path = stop_cache_path(city)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"etag": etag, "last_modified": last_modified, "stops": stops}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"[{city['name']}] stop cache write error:", e)
+
+
+def touch_cached_stops(city):
+    try:
+        os.utime(stop_cache_path(city))
+    except OSError:
+        pass
+
+
+def fetch_stops(city):
+    headers = make_headers(city)
+    cached = stop_validators.get(city["stops_url"])
+    if cached:
+        if cached[0]: headers["If-None-Match"] = cached[0]
+        if cached[1]: headers["If-Modified-Since"] = cached[1]
+    try:
+        budget.take()
+        with stage_seconds.time(city["name"], "stops_fetch"):
+            r = http.get(city["stops_url"], headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304 and cached:
+            touch_cached_stops(city)
+            return cached[2]
+        check_response(city["name"], r)
+        with stage_seconds.time(city["name"], "stops_parse"):
+            data = r.json()
+            stops = data.get("stops", [])
+            result = []
+            for s in stops:
+                if len(s) >= 4:
+                    result.append({
+                        "id": s[0],
+                        "name": s[1],
+                        "lat": s[2],
+                        "lon": s[3],
+                        "stop_name": f"{s[1]} - {s[0]}",
+                        "trip_headsign": s[4] if len(s) > 4 else ""
+                    })
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if cached and cached[2] == result:
+            # unchanged list without validators: keep the cached objects, only refresh the timestamp
+            stop_validators[city["stops_url"]] = (etag, last_modified, cached[2])
+            touch_cached_stops(city)
+            return cached[2]
+        stop_validators[city["stops_url"]] = (etag, last_modified, result)
+        if result: save_cached_stops(city, etag, last_modified, result)
+        return result
+    except Exception as e:
+        upstream_errors.inc(city["name"], type(e).__name__)
+        print(f"[{city['name']}] stop fetch error:", e)
+        return []
+
+
+# ---------- Adaptive polling ----------
+class Cadence:
+    # Learns how often one feed really changes (by content hash) and when the next change is due.
+
+    def __init__(self):
+        self.interval = None
+        self.last_change = None
+        self.last_digest = None
+        self.unchanged = 0
+
+    def observe(self, digest, now):
+        if digest == self.last_digest:
+            self.unchanged += 1
+            return False
+        if self.last_change is not None:
+            sample = now - self.last_change
+            self.interval = sample if self.interval is None else 0.8 * self.interval + 0.2 * sample
+        self.last_change, self.last_digest, self.unchanged = now, digest, 0
+        return True
+
+    def delay(self, now, limit):
+        # how long to wait before the next long-poll, never above limit
+        if self.interval is None: return 0
+        interval = self.interval * 1.5 ** min(self.unchanged, 4)
+        if time.localtime(now).tm_hour in NIGHT_HOURS: interval *= NIGHT_FACTOR
+        return min(max(self.last_change + interval - POLL_LEAD - now, 0), limit)
+
+
+# ---------- Persistent socket.io session ----------
+class SocketSession:
+    # One long-lived Engine.IO polling session per namespace.
+    # Bus frames pushed by upstream are handed to on_buses(data) as they arrive;
+    # on_frame() is called after every vehicles frame, also an unchanged or empty one.
+
+    def __init__(self, ns, headers, on_buses, on_frame=None):
+        self.ns = ns
+        self.namespace = f"/{ns}"
+        self.headers = headers
+        self.on_buses = on_buses
+        self.on_frame = on_frame
+        self.url = None
+        self.ping_interval = 25
+        self.ping_timeout = 20
+        self.running = False
+        self.last_frame = None
+        self.thread = None
+        self.cadence = Cadence()
+        self.staleness = None   # average seconds a frame waited upstream before we fetched it
+        self.polled_at = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        backoff = 1
+        while self.running:
+            connected_at = time.time()
+            try:
+                self.connect()
+                while self.running:
+                    # buffered pings must still be answered within ping_timeout
+                    wait = self.cadence.delay(time.time(), self.ping_timeout / 2)
+                    if wait: time.sleep(wait)
+                    self.poll()
+            except Exception as e:
+                upstream_errors.inc(self.ns, type(e).__name__)
+                print(f"[{self.ns}] socket session error:", e)
+            self.close()
+            if not self.running: break
+            # a session that delivered data was healthy, start backing off from scratch
+            if self.last_frame and self.last_frame > connected_at: backoff = 1
+            time.sleep(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        self.close()
+
+    def connect(self):
+        budget.take()
+        with stage_seconds.time(self.ns, "handshake"):
+            r = http.get(SOCKET, headers=self.headers, timeout=TIMEOUT)
+        check_response(self.ns, r)
+        handshake = next((p for p in decode_payload(r.content) if p.type == OPEN), None)
+        if handshake is None: raise ConnectionError("no open packet in handshake")
+        info = loads(handshake.data)
+        self.ping_interval = info.get("pingInterval", 25000) / 1000
+        self.ping_timeout = info.get("pingTimeout", 20000) / 1000
+        self.url = f"{SOCKET}&sid={info['sid']}"
+        with stage_seconds.time(self.ns, "connect"):
+            self.send(f"40/{self.ns},{{}}")
+
+    def close(self):
+        if not self.url: return
+        try:
+            self.send("1")
+        except Exception:
+            pass
+        self.url = None
+
+    def send(self, packet):
+        budget.take()
+        r = http.post(self.url, headers=self.headers, data=packet, timeout=TIMEOUT)
+        check_response(self.ns, r)
+
+    def poll(self):
+        # long-poll: upstream holds the request until it has packets or a ping is due
+        budget.take()
+        started = time.time()
+        with stage_seconds.time(self.ns, "frame_wait"):
+            r = http.get(self.url, headers=self.headers, timeout=(TIMEOUT[0], self.ping_interval + self.ping_timeout))
+        check_response(self.ns, r)
+        frame = None
+        for packet in decode_payload(r.content):
+            frame = self.handle(packet) or frame
+        now = time.time()
+        gap = started - self.polled_at if self.polled_at else 0
+        self.polled_at = now
+        if frame is None: return
+        # answered right away means the frame sat in upstream's buffer for up to the gap between polls
+        waited = gap if now - started < 0.5 else 0
+        self.staleness = waited if self.staleness is None else 0.8 * self.staleness + 0.2 * waited
+        self.last_frame = now
+        if self.cadence.observe(hash(frame), now):
+            # several buffered frames: only the newest one is decoded
+            with stage_seconds.time(self.ns, "parse"):
+                data = loads(frame)
+            buses = data[1].get("data") if len(data) > 1 and isinstance(data[1], dict) else None
+            # an empty frame keeps the last good data; a stopped session hands nothing on
+            if buses and isinstance(buses, dict) and self.running: self.on_buses(buses)
+        if self.on_frame and self.running: self.on_frame()
+
+    def handle(self, packet):
+        # control packets are handled here; a bus frame's JSON bytes are returned
+        if packet.type == PING:
+            self.send("3")
+        elif packet.type == CLOSE:
+            raise ConnectionError("session closed by upstream")
+        elif packet.type == MESSAGE and packet.namespace == self.namespace:
+            if packet.sio_type == DISCONNECT:
+                raise ConnectionError("namespace disconnected")
+            if packet.sio_type == CONNECT_ERROR:
+                raise ConnectionError(f"namespace connect error: {bytes(packet.data).decode(errors='replace')}")
+            if packet.sio_type == EVENT and bytes(packet.data[:len(VEHICLES_EVENT)]) == VEHICLES_EVENT:
+                return packet.data
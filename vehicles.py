@@ -0,0 +1,111 @@
+from array import array
+import sys
+
+NUMERIC = ("lat", "lon", "angle", "speed", "delay")
+TEXT = ("route_id", "vehicleNo", "trip_headsign", "stop_name", "current_status")
+
+# numeric cells keep their JSON type next to the value so snapshots round-trip exactly
+ABSENT, NULL, INT, FLOAT = 0, 1, 2, 3
+MISSING = object()
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# ---------- Columnar vehicle snapshot ----------
+class VehicleTable:
+    # One city's vehicles as per-field columns: typed arrays for NUMERIC fields and a list of
+    # interned values for every other field seen in the frame. JSON dicts are only built at the edge.
+    __slots__ = ("ids", "index", "numbers", "kinds", "texts")
+
+    def __init__(self, ids, numbers, kinds, texts):
+        self.ids = ids
+        self.index = {vid: i for i, vid in enumerate(ids)}
+        self.numbers = numbers
+        self.kinds = kinds
+        self.texts = texts
+
+    @classmethod
+    def from_buses(cls, buses):
+        ids = []
+        numbers = {f: array("d") for f in NUMERIC}
+        kinds = {f: array("B") for f in NUMERIC}
+        texts = {f: [] for f in TEXT}
+        for n, (vid, bus) in enumerate(buses.items()):
+            ids.append(intern(str(vid)))
+            for k, v in bus.items():
+                if k in numbers:
+                    if isinstance(v, (int, float)) and not isinstance(v, bool):
+                        numbers[k].append(float(v))
+                        kinds[k].append(INT if isinstance(v, int) else FLOAT)
+                        continue
+                    numbers[k].append(0.0)
+                    kinds[k].append(NULL)
+                    if v is None: continue
+                    # odd upstream type (e.g. numeric string): keep it verbatim in a side column
+                    k = f"\0{k}"
+                column = texts.get(k)
+                if column is None: column = texts[k] = [MISSING] * n
+                column.append(intern(v))
+            # pad every column this vehicle did not have
+            for f in NUMERIC:
+                if len(kinds[f]) == n:
+                    numbers[f].append(0.0)
+                    kinds[f].append(ABSENT)
+            for column in texts.values():
+                if len(column) == n: column.append(MISSING)
+        return cls(ids, numbers, kinds, texts)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        if not isinstance(other, VehicleTable): return NotImplemented
+        return self.ids == other.ids and self.numbers == other.numbers and self.kinds == other.kinds and self.texts == other.texts
+
+    def value(self, field, i):
+        if field in self.numbers:
+            kind = self.kinds[field][i]
+            if kind == INT: return int(self.numbers[field][i])
+            if kind == FLOAT: return self.numbers[field][i]
+            if kind == ABSENT: return MISSING
+            odd = self.texts.get(f"\0{field}")
+            return None if odd is None or odd[i] is MISSING else odd[i]
+        column = self.texts.get(field)
+        return MISSING if column is None else column[i]
+
+    def row(self, i):
+        bus = {}
+        for f in NUMERIC:
+            value = self.value(f, i)
+            if value is not MISSING: bus[f] = value
+        for f, column in self.texts.items():
+            if column[i] is not MISSING and not f.startswith("\0"): bus[f] = column[i]
+        return bus
+
+    def get(self, vid):
+        i = self.index.get(vid)
+        return None if i is None else self.row(i)
+
+    def to_dict(self):
+        return {vid: self.row(i) for i, vid in enumerate(self.ids)}
+
+    def positions(self):
+        # (lat, lon, row) for vehicles that have both coordinates
+        lat, lon, klat, klon = self.numbers["lat"], self.numbers["lon"], self.kinds["lat"], self.kinds["lon"]
+        return ((lat[i], lon[i], i) for i in range(len(self.ids)) if klat[i] >= INT and klon[i] >= INT)
+
+    def mean(self, field, rows):
+        # average of a numeric field over the given rows, None when none of them has it
+        values, kinds = self.numbers[field], self.kinds[field]
+        present = [values[i] for i in rows if kinds[i] >= INT]
+        return sum(present) / len(present) if present else None
+
+    def where(self, field, predicate):
+        # row numbers whose numeric field is present and satisfies predicate
+        values, kinds = self.numbers[field], self.kinds[field]
+        return [i for i, v in enumerate(values) if kinds[i] >= INT and predicate(v)]
+
+
+EMPTY = VehicleTable.from_buses({})